@@ -1,5 +1,6 @@
+from .config import load_env
 from .auth import get_temp_user, supabase, create_temp_user, encryption
-from .chat import get_chat_messages, send_chat_prompt, generate_chat_title, SYSTEM_PROMPT, send_image_prompt, send_pdf_prompt
+from .chat import get_chat_messages, send_chat_prompt, send_compare_prompt, generate_chat_title, SYSTEM_PROMPT, send_image_prompt, send_pdf_prompt
 from .models import KeyItem, LoginItem, PromptItem, UpdateTitleItem, UserPreferences, UpdatePreferencesItem, UpdateApiKeyItem, ChatCreationRequest, MessageResponse, ChatResponse, ApiKeyStatus, SignupItem, TitleUpdate, UserResponse, ValidateApiKeyRequest
 from .main import (
     read_root, post_signup, post_login, get_login_status, 
@@ -8,7 +9,7 @@ from .main import (
 
 __all__ = [
     'get_temp_user', 'supabase', 'create_temp_user', 'encryption', 
-    'get_chat_messages', 'send_chat_prompt', 'generate_chat_title', 'SYSTEM_PROMPT', 'send_image_prompt', 'send_pdf_prompt',
+    'get_chat_messages', 'send_chat_prompt', 'send_compare_prompt', 'generate_chat_title', 'SYSTEM_PROMPT', 'send_image_prompt', 'send_pdf_prompt',
     'KeyItem', 'LoginItem', 'PromptItem', 'UpdateTitleItem', 'TitleUpdate', 'UserPreferences', 'UpdatePreferencesItem', 'UpdateApiKeyItem', 'ChatCreationRequest', 'MessageResponse', 'ChatResponse', 'ApiKeyStatus',
     'read_root', 'post_signup', 'post_login', 'get_login_status',
     'get_logout', 'get_models', 'get_chats'
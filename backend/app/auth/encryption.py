@@ -1,4 +1,5 @@
 import os
+import threading
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
@@ -6,6 +7,23 @@ import base64
 
 class APIKeyEncryption:
     def __init__(self):
+        self._cipher = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self) -> bool:
+        return self._cipher is not None
+
+    @property
+    def cipher(self) -> Fernet:
+        # Deriving the key is deliberately slow (PBKDF2), so do it once on first use instead of at import
+        if self._cipher is None:
+            with self._lock:
+                if self._cipher is None:
+                    self._cipher = self._derive_cipher()
+        return self._cipher
+
+    def _derive_cipher(self) -> Fernet:
         encryption_key = os.getenv("ENCRYPTION_KEY")
         if not encryption_key:
             raise ValueError("ENCRYPTION_KEY environment variable not set")
@@ -17,7 +35,7 @@ class APIKeyEncryption:
             iterations=100000,
         )
         key = base64.urlsafe_b64encode(kdf.derive(encryption_key.encode()))
-        self.cipher = Fernet(key)
+        return Fernet(key)
     
     def encrypt_api_key(self, api_key: str) -> str:
         return self.cipher.encrypt(api_key.encode()).decode()
@@ -25,4 +43,4 @@ class APIKeyEncryption:
     def decrypt_api_key(self, encrypted_key: str) -> str:
         return self.cipher.decrypt(encrypted_key.encode()).decode()
 
-encryption = APIKeyEncryption()
\ No newline at end of file
+encryption = APIKeyEncryption()
@@ -1,10 +1,48 @@
-from supabase import create_client, Client
-import dotenv
+from typing import Optional, TYPE_CHECKING
+import app.config
 import os
-from pathlib import Path
+import threading
 
-dotenv.load_dotenv(Path(__file__).parent.parent / ".env")
-supabase: Client = create_client(
-    os.environ["SUPABASE_URL"],
-    os.environ["SUPABASE_ANON_KEY"]
-)
\ No newline at end of file
+if TYPE_CHECKING:
+    from supabase import Client
+
+class LazySupabaseClient:
+    """
+    Stands in for the Supabase client and creates the real one on first use,
+    so importing the app doesn't pay for the supabase import or client setup.
+    Attribute access is forwarded, so `supabase.table(...)` works as before.
+    """
+
+    def __init__(self, key_env: str = "SUPABASE_ANON_KEY"):
+        self.key_env = key_env
+        self._client: Optional["Client"] = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self) -> bool:
+        return self._client is not None
+
+    @property
+    def configured(self) -> bool:
+        return bool(os.getenv(self.key_env))
+
+    def get(self) -> "Client":
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from supabase import create_client
+                    self._client = create_client(
+                        os.environ["SUPABASE_URL"],
+                        os.environ[self.key_env]
+                    )
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+supabase = LazySupabaseClient()
+
+# Bypasses RLS. Only used by chat archiving, which works across every user's
+# chats and keeps its blobs in a bucket clients can't read directly, and by
+# usage accounting, which writes every user's usage events in shared batches.
+supabase_admin = LazySupabaseClient("SUPABASE_SERVICE_ROLE_KEY")
@@ -1,3 +1,5 @@
-from .functions import get_chat_messages, send_chat_prompt, generate_chat_title, send_image_prompt, send_pdf_prompt, send_text_prompt
+from .functions import get_chat_messages, save_message, send_chat_prompt, send_compare_prompt, stream_completion, get_openrouter_key, generate_chat_title, send_image_prompt, send_pdf_prompt, send_text_prompt
+from .history import history_cache
+from .batch import start_batch, get_batch_status
 from .prompts import SYSTEM_PROMPT
-__all__ = ['get_chat_messages', 'send_chat_prompt', 'generate_chat_title', 'SYSTEM_PROMPT', 'send_image_prompt', 'send_pdf_prompt', 'send_text_prompt']
\ No newline at end of file
+__all__ = ['get_chat_messages', 'save_message', 'send_chat_prompt', 'send_compare_prompt', 'stream_completion', 'get_openrouter_key', 'generate_chat_title', 'SYSTEM_PROMPT', 'send_image_prompt', 'send_pdf_prompt', 'send_text_prompt', 'history_cache', 'start_batch', 'get_batch_status']
\ No newline at end of file
@@ -0,0 +1,241 @@
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, List
+
+from app.auth.supabase_client import supabase_admin
+from .history import history_cache
+from .writer import message_writer
+
+import os
+import json
+import uuid
+import socket
+import threading
+import logging
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+# Chats with no messages for this many days are archived; 0 turns the job off
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+ARCHIVE_BUCKET = os.getenv("ARCHIVE_BUCKET", "chat-archives")
+ARCHIVE_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", "10"))
+ARCHIVE_VERSION = 1
+LOCK_STRIPES = 64
+LEASE_NAME = "chat-archiver"
+
+def archive_path(user_id: str, chat_id: str) -> str:
+    return f"{user_id}/{chat_id}.json.zst"
+
+def pack(chat_id: str, rows: List[Dict[str, Any]]) -> bytes:
+    document = {"version": ARCHIVE_VERSION, "chatId": chat_id, "messages": rows}
+    return zstandard.ZstdCompressor(level=ARCHIVE_LEVEL).compress(json.dumps(document, default=str).encode("utf-8"))
+
+def unpack(blob: bytes) -> Dict[str, Any]:
+    document = json.loads(zstandard.ZstdDecompressor().decompress(blob))
+    if document.get("version") != ARCHIVE_VERSION:
+        raise ValueError(f"Unsupported archive version: {document.get('version')}")
+    return document
+
+def load_archived_messages(path: str) -> List[Dict[str, Any]]:
+    """The messages stored in one chat's archive blob."""
+    return unpack(supabase_admin.storage.from_(ARCHIVE_BUCKET).download(path))["messages"]
+
+class ChatArchiver:
+    """
+    Moves cold chats out of the messages table. A chat whose newest message is
+    older than ARCHIVE_AFTER_DAYS has its rows written to a zstd-compressed JSON
+    blob in storage and deleted, leaving the chats row as a stub that points at
+    the blob. Opening or continuing the chat puts the rows back first.
+    Chats that are part of a branch (a fork, or forked from) stay hot.
+
+    The job works on every user's chats, so it runs on the service-role client
+    (SUPABASE_SERVICE_ROLE_KEY) and is off without one. Every worker runs the
+    loop, but a pass only does anything in the worker holding the job lease.
+    """
+
+    def __init__(self, after_days: int = ARCHIVE_AFTER_DAYS, interval: float = ARCHIVE_INTERVAL,
+                 batch_size: int = ARCHIVE_BATCH_SIZE):
+        self.after_days = after_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        # Archiving and rehydrating the same chat never overlap within this worker
+        self._chat_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self.archived_chats = 0
+        self.archived_messages = 0
+        self.bytes_reclaimed = 0
+        self.blob_bytes = 0
+        self.rehydrated_chats = 0
+        self.failures = 0
+        self.totals: Dict[str, Any] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.after_days > 0 and supabase_admin.configured
+
+    def run_once(self) -> int:
+        """Archive one batch of cold chats if this worker is the leader. Returns how many were archived."""
+        if not self._claim_lease():
+            return 0
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.after_days)
+        candidates = supabase_admin.rpc("archivable_chats", {
+            "p_cutoff": cutoff.isoformat(),
+            "p_limit":  self.batch_size
+        }).execute().data or []
+
+        archived = 0
+        for chat in candidates:
+            if self._stop.is_set():
+                break
+            try:
+                archived += self.archive_chat(chat["id"], chat["user_id"])
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Failed to archive chat {chat['id']}: {e}")
+        self._refresh_totals()
+        return archived
+
+    def archive_chat(self, chat_id: str, user_id: str) -> bool:
+        if message_writer.pending(chat_id):
+            # Someone is writing to it right now, so it isn't cold
+            return False
+        with self._chat_lock(chat_id):
+            rows = supabase_admin.table("messages") \
+                .select("*") \
+                .eq("chat_id", chat_id) \
+                .order("created_at") \
+                .execute().data or []
+            if not rows:
+                return False
+
+            path = archive_path(user_id, chat_id)
+            blob = pack(chat_id, rows)
+            hot_bytes = sum(len(json.dumps(row, default=str)) for row in rows)
+            supabase_admin.storage.from_(ARCHIVE_BUCKET).upload(
+                path, blob, {"content-type": "application/zstd", "upsert": "true"}
+            )
+            # Deletes the rows only if nothing was written since they were read
+            done = supabase_admin.rpc("archive_chat", {
+                "p_chat_id":         chat_id,
+                "p_path":            path,
+                "p_messages":        len(rows),
+                "p_bytes":           hot_bytes,
+                "p_last_created_at": rows[-1]["created_at"]
+            }).execute().data
+            if not done:
+                return False
+
+            history_cache.invalidate(chat_id)
+            with self._lock:
+                self.archived_chats += 1
+                self.archived_messages += len(rows)
+                self.bytes_reclaimed += hot_bytes
+                self.blob_bytes += len(blob)
+            logger.info(f"Archived chat {chat_id}: {len(rows)} messages, {hot_bytes} bytes -> {len(blob)} bytes")
+            return True
+
+    def rehydrate(self, chat_id: str) -> bool:
+        """Restore an archived chat's messages. Returns False if the chat isn't archived."""
+        if not supabase_admin.configured:
+            # Archiving can't have run without it, so nothing is archived
+            return False
+        with self._chat_lock(chat_id):
+            chat = supabase_admin.table("chats") \
+                .select("archive_path") \
+                .eq("id", chat_id) \
+                .execute()
+            path = chat.data[0].get("archive_path") if chat.data else None
+            if not path:
+                return False
+
+            rows = load_archived_messages(path)
+            supabase_admin.rpc("restore_chat", {"p_chat_id": chat_id, "p_messages": rows}).execute()
+            try:
+                supabase_admin.storage.from_(ARCHIVE_BUCKET).remove([path])
+            except Exception as e:
+                # The chat is already back; an orphaned blob only costs storage
+                logger.error(f"Failed to remove archive blob {path}: {e}")
+
+            history_cache.invalidate(chat_id)
+            with self._lock:
+                self.rehydrated_chats += 1
+            logger.info(f"Rehydrated chat {chat_id}: {len(rows)} messages")
+            return True
+
+    def start(self):
+        if self.after_days <= 0:
+            return
+        if not supabase_admin.configured:
+            logger.warning("ARCHIVE_AFTER_DAYS is set but SUPABASE_SERVICE_ROLE_KEY isn't; chat archiving is off")
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="chat-archiver", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled":           self.enabled,
+                "after_days":        self.after_days,
+                "leader":            self.leader,
+                "archived_chats":    self.archived_chats,
+                "archived_messages": self.archived_messages,
+                "bytes_reclaimed":   self.bytes_reclaimed,
+                "blob_bytes":        self.blob_bytes,
+                "rehydrated_chats":  self.rehydrated_chats,
+                "failures":          self.failures,
+                "totals":            self.totals,
+            }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Archive pass failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _refresh_totals(self):
+        # Database-wide figures, so they cover every worker's archiving
+        try:
+            result = supabase_admin.table("chat_archive_stats").select("*").execute()
+            totals = result.data[0] if result.data else {}
+        except Exception as e:
+            logger.error(f"Failed to load archive totals: {e}")
+            return
+        with self._lock:
+            self.totals = totals
+
+    def _claim_lease(self) -> bool:
+        # Held for two intervals and renewed every pass, so another worker takes over if this one dies
+        try:
+            claimed = supabase_admin.rpc("claim_job_lease", {
+                "p_name":    LEASE_NAME,
+                "p_holder":  self.worker_id,
+                "p_seconds": int(self.interval * 2)
+            }).execute().data
+        except Exception as e:
+            logger.error(f"Failed to claim the archive job lease: {e}")
+            claimed = False
+        self.leader = bool(claimed)
+        return self.leader
+
+    def _chat_lock(self, chat_id: str) -> threading.Lock:
+        return self._chat_locks[hash(chat_id) % LOCK_STRIPES]
+
+archiver = ChatArchiver()
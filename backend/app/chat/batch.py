@@ -0,0 +1,217 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+from postgrest.base_request_builder import APIResponse
+
+from app.models import PromptItem, BatchRequest
+from app.auth.supabase_client import supabase
+from .functions import send_chat_prompt, get_openrouter_key
+from .writer import utc_now
+from .scheduler import BATCH
+from .usage import usage_quota
+from .catalog import model_catalog
+
+import os
+import json
+import time
+import uuid
+import gotrue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+BATCH_DIR = Path(os.getenv("BATCH_OUTPUT_DIR", "batches"))
+MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+def batch_paths(batch_id: str) -> Tuple[Path, Path]:
+    """The stored request and the JSONL results artifact for a batch."""
+    # batch ids are uuids we generated; normalising stops them being used as paths
+    batch_id = str(uuid.UUID(batch_id))
+    return BATCH_DIR / f"{batch_id}.request.json", BATCH_DIR / f"{batch_id}.jsonl"
+
+def load_results(batch_id: str) -> Dict[Tuple[int, str], Dict[str, Any]]:
+    """Latest result line per (index, model). Retried items appear more than once in the file."""
+    _, results_path = batch_paths(batch_id)
+    results = {}
+    if not results_path.exists():
+        return results
+    with results_path.open() as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A worker killed mid-write can leave a partial last line
+                continue
+            results[(result["index"], result["model"])] = result
+    return results
+
+def load_batch_request(batch_id: str) -> Optional[Tuple[str, BatchRequest]]:
+    """The owning user id and original request of a batch, if it has been run here before."""
+    request_path, _ = batch_paths(batch_id)
+    if not request_path.exists():
+        return None
+    stored = json.loads(request_path.read_text())
+    return stored["userId"], BatchRequest.model_validate(stored["request"])
+
+class BatchRun:
+    """
+    Runs every prompt x model pair of a batch through the regular chat pipeline
+    with bounded concurrency, appending one JSON line per finished item. Items
+    that already succeeded in an earlier run of the same batch are skipped.
+    """
+
+    def __init__(self, batch_id: str, request: BatchRequest, user: gotrue.types.User):
+        self.batch_id = batch_id
+        self.request = request
+        self.user = user
+        self.concurrency = max(1, min(request.concurrency, MAX_CONCURRENCY))
+        self._lock = threading.Lock()
+        self.started = 0
+        self.finished = 0
+        self.failed = 0
+        self.skipped = 0
+        self.total = len(request.prompts) * len(request.models)
+        self.done = threading.Event()
+
+    def pending_items(self) -> List[Tuple[int, str, str]]:
+        completed = {key for key, result in load_results(self.batch_id).items() if result["status"] == "ok"}
+        items = []
+        for index, prompt in enumerate(self.request.prompts):
+            for model in self.request.models:
+                if (index, model) in completed:
+                    self.skipped += 1
+                else:
+                    items.append((index, model, prompt))
+        return items
+
+    def save_request(self):
+        request_path, _ = batch_paths(self.batch_id)
+        BATCH_DIR.mkdir(parents=True, exist_ok=True)
+        request_path.write_text(json.dumps({"userId": self.user.id, "request": self.request.model_dump()}))
+
+    def run(self):
+        _, results_path = batch_paths(self.batch_id)
+        try:
+            items = self.pending_items()
+            logger.info(f"Batch {self.batch_id}: {len(items)} items to run, {self.skipped} already done")
+            with results_path.open("a") as out, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = [pool.submit(self.run_item, entry) for entry in items]
+                for future in as_completed(futures):
+                    result = future.result()
+                    with self._lock:
+                        out.write(json.dumps(result) + "\n")
+                        out.flush()
+        finally:
+            self.done.set()
+
+    def run_item(self, entry: Tuple[int, str, str]) -> Dict[str, Any]:
+        index, model, prompt = entry
+        with self._lock:
+            self.started += 1
+
+        # Each attempt gets a fresh chat so a retry never sees a failed attempt's history
+        chat_id = str(uuid.uuid4())
+        item = PromptItem(chatId=chat_id, model=model, prompt=prompt, webSearchEnabled=self.request.webSearchEnabled)
+        usage: Dict[str, Any] = {}
+        chunks = []
+        first_token_at = None
+        error = None
+
+        start = time.monotonic()
+        try:
+            # Looked up per item, so saving a key mid-batch moves the rest of it off the shared quota
+            openrouter_key = get_openrouter_key(self.user)
+            usage_quota.check(self.user.id, openrouter_key)
+            # Fails the item before any upstream call if the model is gone or the prompt can't fit
+            model_catalog.route(model, prompt_chars=len(prompt))
+            supabase.table("chats").insert({
+                "id":      chat_id,
+                "user_id": self.user.id,
+                "title":   f"Batch {self.batch_id[:8]} #{index} ({model})"
+            }).execute()
+            reply = send_chat_prompt(item, self.user, APIResponse(data=[], count=None), usage, BATCH, openrouter_key,
+                                     raise_errors=True)
+            for content in reply:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                chunks.append(content)
+        except Exception as e:
+            logger.error(f"Batch {self.batch_id} item {index} ({model}) failed: {e}")
+            error = str(e)
+        latency = time.monotonic() - start
+
+        output = "".join(chunks)
+
+        with self._lock:
+            self.finished += 1
+            if error:
+                self.failed += 1
+
+        return {
+            "batchId":     self.batch_id,
+            "index":       index,
+            "model":       model,
+            "prompt":      prompt,
+            "chatId":      chat_id,
+            "status":      "error" if error else "ok",
+            "output":      None if error else output,
+            "error":       error,
+            "latency_ms":  round(latency * 1000),
+            "ttft_ms":     round((first_token_at - start) * 1000) if first_token_at else None,
+            "usage": {
+                "prompt_tokens":     usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "total_tokens":      usage.get("total_tokens"),
+                "cost":              usage.get("cost"),
+            },
+            "finished_at": utc_now()
+        }
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "batchId":  self.batch_id,
+                "running":  not self.done.is_set(),
+                "total":    self.total,
+                "skipped":  self.skipped,
+                "started":  self.started,
+                "finished": self.finished,
+                "failed":   self.failed,
+            }
+
+_runs: Dict[str, BatchRun] = {}
+_runs_lock = threading.Lock()
+
+def start_batch(request: BatchRequest, user: gotrue.types.User, batch_id: Optional[str] = None) -> BatchRun:
+    """Start (or resume) a batch in the background. Only one run per batch id at a time."""
+    batch_id = batch_id or str(uuid.uuid4())
+    with _runs_lock:
+        current = _runs.get(batch_id)
+        if current is not None and not current.done.is_set():
+            return current
+        run = BatchRun(batch_id, request, user)
+        run.save_request()
+        _runs[batch_id] = run
+    threading.Thread(target=run.run, name=f"batch-{batch_id[:8]}", daemon=True).start()
+    return run
+
+def get_batch_status(batch_id: str) -> Optional[Dict[str, Any]]:
+    """Progress of a batch, from the live run if there is one, otherwise from its artifact."""
+    with _runs_lock:
+        run = _runs.get(batch_id)
+    if run is not None:
+        return run.status()
+
+    stored = load_batch_request(batch_id)
+    if stored is None:
+        return None
+    _, request = stored
+    results = load_results(batch_id)
+    return {
+        "batchId":  batch_id,
+        "running":  False,
+        "total":    len(request.prompts) * len(request.models),
+        "finished": len(results),
+        "failed":   sum(1 for result in results.values() if result["status"] != "ok"),
+    }
@@ -0,0 +1,231 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, FrozenSet, Iterable
+
+from app.clients import get_http_session
+
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+MODELS_URL = "https://openrouter.ai/api/v1/models"
+CATALOG_TTL = float(os.getenv("MODEL_CATALOG_TTL", "600"))
+RETRY_AFTER_FAILURE = 30.0
+ROUTING_PREFERENCE = os.getenv("MODEL_ROUTING_PREFERENCE", "cheapest")  # or "fastest"
+
+# How much search context native web search asks the provider for: low, medium or high
+WEB_SEARCH_CONTEXT = os.getenv("WEB_SEARCH_CONTEXT_SIZE", "medium")
+
+# Rough characters-per-token ratio used to reject prompts that can't fit a model's context
+CHARS_PER_TOKEN = 4
+
+class ModelRoutingError(Exception):
+    """No model can serve the request, so it shouldn't be sent upstream at all."""
+
+@dataclass(frozen=True)
+class ModelCapabilities:
+    id: str
+    input_modalities: FrozenSet[str]
+    context_length: int
+    prompt_price: float
+    completion_price: float
+    native_web_search: bool
+
+    @property
+    def price(self) -> float:
+        return self.prompt_price + self.completion_price
+
+    @property
+    def vendor(self) -> str:
+        return self.id.split("/", 1)[0]
+
+def _price(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def base_model(model: str) -> str:
+    """Strip the routing suffixes OpenRouter accepts on top of catalogue ids."""
+    return model[:-len(":online")] if model.endswith(":online") else model
+
+class ModelCatalog:
+    """
+    The OpenRouter model list, cached for CATALOG_TTL seconds and indexed by id
+    and by input modality so routing decisions are dictionary lookups. Also keeps
+    a moving average of observed time-to-first-token per model for "fastest" routing.
+    """
+
+    def __init__(self, ttl: float = CATALOG_TTL):
+        self.ttl = ttl
+        self._raw: Optional[Dict[str, Any]] = None
+        self._by_id: Dict[str, ModelCapabilities] = {}
+        self._by_modality: Dict[str, List[ModelCapabilities]] = {}
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+        self._capable: Dict[FrozenSet[str], List[ModelCapabilities]] = {}
+        self._latency: Dict[str, float] = {}
+        self._latency_lock = threading.Lock()
+
+    def raw(self) -> Optional[Dict[str, Any]]:
+        """The catalogue exactly as OpenRouter returned it (what GET /models serves)."""
+        self._ensure_fresh()
+        return self._raw
+
+    def get(self, model: str) -> Optional[ModelCapabilities]:
+        self._ensure_fresh()
+        return self._by_id.get(base_model(model))
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._by_id)
+
+    def capable(self, modalities: Iterable[str]) -> List[ModelCapabilities]:
+        """Models accepting every given input modality, cheapest first."""
+        self._ensure_fresh()
+        modalities = frozenset(modalities) or frozenset({"text"})
+        capable = self._capable.get(modalities)
+        if capable is None:
+            # Start from the smallest modality bucket and filter the rest; remembered until the next refresh
+            buckets = sorted((self._by_modality.get(modality, []) for modality in modalities), key=len)
+            capable = [model for model in buckets[0] if modalities <= model.input_modalities]
+            self._capable[modalities] = capable
+        return capable
+
+    def route(self, requested: str, needs: Iterable[str] = (), prompt_chars: int = 0,
+              prefer: str = ROUTING_PREFERENCE) -> str:
+        """
+        Pick the model to send a request to. The requested model is used whenever
+        it can handle the input; otherwise the cheapest (or fastest observed)
+        capable model is chosen, preferring the requested model's vendor.
+        Raises ModelRoutingError if nothing can serve the request.
+        """
+        needs = set(needs)
+        self._ensure_fresh()
+        if not self.loaded:
+            # Without a catalogue we can't second-guess the client
+            return requested
+
+        suffix = ":online" if requested.endswith(":online") else ""
+        min_context = prompt_chars // CHARS_PER_TOKEN
+        current = self.get(requested)
+        if current is None and not needs:
+            raise ModelRoutingError(f"Unknown model: {requested}")
+        if current is not None and needs <= current.input_modalities:
+            if current.context_length and min_context > current.context_length:
+                raise ModelRoutingError(
+                    f"Prompt is about {min_context} tokens but {current.id} accepts at most {current.context_length}"
+                )
+            return requested
+
+        candidates = [
+            model for model in self.capable(needs)
+            if not model.id.endswith(":free") and (not model.context_length or model.context_length >= min_context)
+        ]
+        if not candidates:
+            raise ModelRoutingError(f"No available model supports {', '.join(sorted(needs)) or 'this request'}")
+
+        if current is not None:
+            same_vendor = [model for model in candidates if model.vendor == current.vendor]
+            candidates = same_vendor or candidates
+
+        if prefer == "fastest":
+            observed = [model for model in candidates if model.id in self._latency]
+            if observed:
+                return min(observed, key=lambda model: self._latency[model.id]).id + suffix
+        return candidates[0].id + suffix
+
+    def web_search(self, model: str) -> Dict[str, Any]:
+        """
+        Payload fields that turn on web search for a model. Models the catalogue
+        lists with native search get the provider's own search through
+        web_search_options; everything else goes through OpenRouter's web plugin
+        (the :online suffix), which works with any model.
+        """
+        model = base_model(model)
+        capabilities = self.get(model)
+        if capabilities is not None and capabilities.native_web_search:
+            return {"model": model, "web_search_options": {"search_context_size": WEB_SEARCH_CONTEXT}}
+        return {"model": f"{model}:online"}
+
+    def record_latency(self, model: str, seconds: float, alpha: float = 0.2):
+        """Fold an observed time-to-first-token into the model's moving average."""
+        model = base_model(model)
+        with self._latency_lock:
+            previous = self._latency.get(model)
+            self._latency[model] = seconds if previous is None else previous + alpha * (seconds - previous)
+
+    def _ensure_fresh(self):
+        if time.monotonic() - self._fetched_at < self.ttl:
+            return
+        if self._raw is None:
+            # Nothing to serve yet, so the caller has to wait for the first fetch
+            with self._fetch_lock:
+                self._refresh()
+            return
+        # Keep answering from the stale index while one thread fetches the new one
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name="model-catalog-refresh", daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            with self._fetch_lock:
+                self._refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _refresh(self):
+        # Caller holds self._fetch_lock
+        if time.monotonic() - self._fetched_at < self.ttl:
+            return
+        try:
+            self._load(self._fetch())
+            self._fetched_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Failed to refresh model catalogue: {e}")
+            # Keep serving the stale index, and don't hammer OpenRouter while it's failing
+            self._fetched_at = time.monotonic() - self.ttl + min(self.ttl, RETRY_AFTER_FAILURE)
+
+    def _fetch(self) -> Dict[str, Any]:
+        headers = {"Content-Type": "application/json"}
+        if os.getenv("OPEN_ROUTER_KEY"):
+            headers["Authorization"] = f'Bearer {os.getenv("OPEN_ROUTER_KEY")}'
+        r = get_http_session().get(MODELS_URL, headers=headers, timeout=10.0)
+        r.raise_for_status()
+        return r.json()
+
+    def _load(self, raw: Dict[str, Any]):
+        by_id: Dict[str, ModelCapabilities] = {}
+        for entry in raw.get("data", []):
+            architecture = entry.get("architecture") or {}
+            pricing = entry.get("pricing") or {}
+            prompt_price = _price(pricing.get("prompt"))
+            completion_price = _price(pricing.get("completion"))
+            if prompt_price < 0 or completion_price < 0:
+                # Meta-routers like openrouter/auto report negative prices
+                continue
+            by_id[entry["id"]] = ModelCapabilities(
+                id=entry["id"],
+                input_modalities=frozenset(architecture.get("input_modalities") or ["text"]),
+                context_length=entry.get("context_length") or 0,
+                prompt_price=prompt_price,
+                completion_price=completion_price,
+                native_web_search="web_search_options" in (entry.get("supported_parameters") or []),
+            )
+
+        by_modality: Dict[str, List[ModelCapabilities]] = {}
+        for model in sorted(by_id.values(), key=lambda model: (model.price, model.id)):
+            for modality in model.input_modalities:
+                by_modality.setdefault(modality, []).append(model)
+
+        self._raw, self._by_id, self._by_modality, self._capable = raw, by_id, by_modality, {}
+
+model_catalog = ModelCatalog()
@@ -0,0 +1,189 @@
+from typing import Optional, Dict, Any, List, Iterator, Iterable
+
+from app.auth.supabase_client import supabase
+from .writer import message_writer, utc_now
+from .archive import load_archived_messages
+
+import os
+import json
+import uuid
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+EXPORT_VERSION = 1
+
+# Imported ids are derived from the importing user and the original id
+IMPORT_NAMESPACE = uuid.UUID("6f1c3a52-9d7e-4b8a-a0e4-2b5f8c1d7e93")
+
+def _line(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, default=str) + "\n").encode("utf-8")
+
+def _quote(value: Any) -> str:
+    # PostgREST filter values containing reserved characters (timestamps) must be quoted
+    return '"' + str(value).replace('"', '\\"') + '"'
+
+def iter_chats(user_id: str, page_size: int = EXPORT_PAGE_SIZE, archived: bool = False) -> Iterator[Dict[str, Any]]:
+    """A user's chats (or only the archived ones) in id order, one keyset page at a time."""
+    last_id = None
+    while True:
+        query = supabase.table("chats").select("*").eq("user_id", user_id)
+        if archived:
+            query = query.not_.is_("archive_path", "null")
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        page = query.order("id").limit(page_size).execute().data or []
+        yield from page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]["id"]
+
+def iter_messages(user_id: str, page_size: int = EXPORT_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Every message in a user's chats in (created_at, id) order, one keyset page
+    at a time off the (user_id, created_at, id) index. A parent is always older
+    than its replies, so this order also lets an import insert each message
+    after the one it points to.
+    """
+    last = None
+    while True:
+        query = supabase.table("messages").select("*").eq("user_id", user_id)
+        if last is not None:
+            created_at, message_id = _quote(last["created_at"]), _quote(last["id"])
+            query = query.or_(f"created_at.gt.{created_at},and(created_at.eq.{created_at},id.gt.{message_id})")
+        page = query.order("created_at").order("id").limit(page_size).execute().data or []
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+def export_user_data(user_id: str, page_size: int = EXPORT_PAGE_SIZE) -> Iterator[bytes]:
+    """
+    NDJSON export of a user's chats and messages: a header line, then every
+    chat, then every message, each tagged with its "type". Only one page is
+    held in memory at a time.
+    """
+    # Make sure messages queued before the export started are included
+    message_writer.flush(timeout=5.0)
+
+    yield _line({"type": "export", "version": EXPORT_VERSION, "userId": user_id, "exportedAt": utc_now()})
+    for chat in iter_chats(user_id, page_size):
+        yield _line({"type": "chat", **chat})
+    for message in iter_messages(user_id, page_size):
+        yield _line({"type": "message", **message})
+    # Archived chats are self-contained (never part of a branch), so their messages can come last
+    for chat in iter_chats(user_id, page_size, archived=True):
+        for message in load_archived_messages(chat["archive_path"]):
+            yield _line({"type": "message", **message})
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Gzip a byte stream incrementally."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+class ChatImportError(Exception):
+    """An import line was malformed or a batch was rejected by the database."""
+
+class ChatImporter:
+    """
+    Loads an export into a user's account in batches. Each batch is one call
+    to the import_chat_batch database function, so it commits or fails as a
+    whole. Ids are remapped deterministically per user, which keeps imports
+    from colliding with anyone else's rows and makes re-running a partly
+    failed import safe: rows that already made it are skipped.
+    """
+
+    def __init__(self, user_id: str, batch_size: int = IMPORT_BATCH_SIZE):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self._chats: List[Dict[str, Any]] = []
+        self._messages: List[Dict[str, Any]] = []
+        self._forks: List[Dict[str, Any]] = []
+        self.lines = 0
+        self.batches = 0
+        self.chats = 0
+        self.messages = 0
+
+    def map_id(self, original: Optional[str]) -> Optional[str]:
+        if not original:
+            return None
+        return str(uuid.uuid5(IMPORT_NAMESPACE, f"{self.user_id}:{original}"))
+
+    def feed_line(self, line: bytes):
+        line = line.strip()
+        if not line:
+            return
+        self.lines += 1
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ChatImportError(f"Line {self.lines} is not valid JSON: {e}")
+        self.feed(record)
+
+    def feed(self, record: Dict[str, Any]):
+        kind = record.pop("type", None)
+        if kind == "export":
+            if record.get("version") != EXPORT_VERSION:
+                raise ChatImportError(f"Unsupported export version: {record.get('version')}")
+            return
+        if kind == "chat":
+            chat_id = self.map_id(record.get("id"))
+            self._chats.append({
+                "id":         chat_id,
+                "title":      record.get("title"),
+                "created_at": record.get("created_at") or utc_now()
+            })
+            # Fork points can live in chats that come later in the file; they're linked at the end
+            if record.get("forked_from"):
+                self._forks.append({"chat_id": chat_id, "forked_from": self.map_id(record["forked_from"])})
+        elif kind == "message":
+            self._messages.append({
+                # user_id is set by the database from the chat it lands in
+                **{key: value for key, value in record.items() if key not in ("id", "chat_id", "parent_id", "user_id")},
+                "id":         self.map_id(record.get("id")),
+                "chat_id":    self.map_id(record.get("chat_id")),
+                "parent_id":  self.map_id(record.get("parent_id")),
+                "created_at": record.get("created_at") or utc_now()
+            })
+        else:
+            raise ChatImportError(f"Line {self.lines} has unknown type: {kind}")
+
+        if len(self._chats) + len(self._messages) >= self.batch_size:
+            self.flush()
+
+    def flush(self, final: bool = False):
+        if not self._chats and not self._messages and not (final and self._forks):
+            return
+        try:
+            result = supabase.rpc("import_chat_batch", {
+                "p_user_id":  self.user_id,
+                "p_chats":    self._chats,
+                "p_messages": self._messages,
+                "p_forks":    self._forks if final else []
+            }).execute()
+        except Exception as e:
+            raise ChatImportError(f"Batch {self.batches + 1} was rejected: {e}")
+        counts = result.data or {}
+        self.chats += counts.get("chats", 0)
+        self.messages += counts.get("messages", 0)
+        self.batches += 1
+        self._chats, self._messages = [], []
+
+    def finish(self) -> Dict[str, int]:
+        self.flush(final=True)
+        return self.summary()
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "lines":    self.lines,
+            "batches":  self.batches,
+            "chats":    self.chats,
+            "messages": self.messages,
+        }
@@ -1,30 +1,116 @@
 from fastapi import UploadFile
 from postgrest.base_request_builder import APIResponse
+from typing import Optional, List, Callable
 from app.models import PromptItem
 from .prompts import SYSTEM_PROMPT
+from .history import history_cache
+from .writer import message_writer, utc_now
+from .catalog import model_catalog, base_model
+from .usage import record_usage
+from .archive import archiver
+from .payload import build_messages, content_text
+from .scheduler import upstream_scheduler, credential_id, prompt_cost, SchedulerTimeout, INTERACTIVE, BACKGROUND
 from app.auth.supabase_client import supabase
 from app.auth.encryption import encryption
+from app.clients import get_http_session
 from postgrest.base_request_builder import APIResponse
 
 import os
 import json
+import uuid
+import time
+import queue
+import threading
 import gotrue
 import base64
-import requests
 import logging
 
 logger = logging.getLogger(__name__)
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
 def get_chat_messages(chatId:str):
-    return supabase.table("messages") \
-        .select("*") \
-        .eq("chat_id", chatId) \
-        .execute()
+    """
+    The messages on the chat's current branch, oldest first: the path from its
+    newest message (or, for a fresh fork, the message it was forked from) back
+    to the root, which can run through the chat it was forked from.
+    """
+    # Serve from the in-memory history if the newest row in the db is still the one we have cached
+    cached = history_cache.get(chatId)
+    if cached is not None and message_writer.pending(chatId):
+        # Our own writes for this chat haven't landed yet, so the cache is ahead of the db
+        return APIResponse(data=cached, count=None)
+    if cached is not None:
+        latest = supabase.table("messages") \
+            .select("id") \
+            .eq("chat_id", chatId) \
+            .order("created_at", desc=True) \
+            .limit(1) \
+            .execute()
+        if history_cache.is_current(chatId, latest.data[0] if latest.data else None):
+            return APIResponse(data=cached, count=None)
 
-# Send chat
-def send_chat_prompt(item: PromptItem, user: gotrue.types.User, messages: APIResponse):
-    logger.info(f"Prompt: {item.prompt}")
-    
+    if message_writer.pending(chatId):
+        message_writer.flush(timeout=5.0, key_value=chatId)
+    # One recursive query walks parent_id from the branch head (see the chat_history function)
+    messages = supabase.rpc("chat_history", {"p_chat_id": chatId}).execute()
+    if not messages.data and archiver.rehydrate(chatId):
+        # The chat was archived for inactivity; its rows are back in the table now
+        messages = supabase.rpc("chat_history", {"p_chat_id": chatId}).execute()
+    messages.data.sort(key=lambda m: m.get("created_at"))
+    history_cache.put(chatId, messages.data)
+    return messages
+
+def save_message(chatId: str, model: str, content: str, speaker: str, parent_id: Optional[str] = None):
+    """
+    Queue a message row for the write-behind writer and add it to the chat's cached history.
+    The id and created_at are assigned here so the row is complete before it reaches the db.
+    """
+    row = {
+        "id":          str(uuid.uuid4()),
+        "chat_id":     chatId,
+        "parent_id":   parent_id,
+        "provider_id": model,
+        "content":     content,
+        "speaker":     speaker,
+        "created_at":  utc_now()
+    }
+    message_writer.enqueue(row)
+    history_cache.append(chatId, row)
+    return row
+
+class BranchTip:
+    """
+    The message a chat's next saved message attaches to. Every save moves the
+    tip forward, so compare-mode replies sharing one tip chain in the order
+    they finish and all stay on the branch.
+    """
+
+    def __init__(self, chatId: str, parent_id: Optional[str]):
+        self.chatId = chatId
+        self.parent_id = parent_id
+        self._lock = threading.Lock()
+
+    def save(self, model: str, content: str, speaker: str):
+        with self._lock:
+            row = save_message(self.chatId, model, content, speaker, self.parent_id)
+            self.parent_id = row["id"]
+            return row
+
+def branch_tip(chatId: str, messages: Optional[APIResponse] = None) -> BranchTip:
+    """The tip of the chat's current branch, from already loaded history if there is some."""
+    rows = (messages if messages is not None else get_chat_messages(chatId)).data
+    return BranchTip(chatId, rows[-1].get("id") if rows else None)
+
+class UpstreamError(Exception):
+    """OpenRouter answered a completion request with a non-2xx status."""
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"{status_code} - {body}")
+        self.status_code = status_code
+        self.body = body
+
+def get_openrouter_key(user: gotrue.types.User) -> str:
+    """The user's own OpenRouter key if they saved one, otherwise the shared server key."""
     api_key = None
     if not user.is_anonymous:
         try:
@@ -34,81 +120,215 @@ def send_chat_prompt(item: PromptItem, user: gotrue.types.User, messages: APIRes
                 api_key = encryption.decrypt_api_key(encrypted_key)
         except Exception as e:
             logger.error(f"Failed to get user API key: {e}")
-        
+
     openrouter_key = api_key or os.getenv("OPEN_ROUTER_KEY")
     if not openrouter_key:
         raise Exception("No API key available")
-            
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    return openrouter_key
+
+def payload_text(payload: dict) -> str:
+    return "".join(content_text(message.get("content")) for message in payload.get("messages", []))
+
+def payload_cost(payload: dict) -> float:
+    return prompt_cost(payload_text(payload))
+
+def stream_completion(openrouter_key: str, payload: dict, usage: Optional[dict] = None,
+                      user_id: Optional[str] = None, priority: int = INTERACTIVE, chat_id: Optional[str] = None):
+    """
+    Stream a chat completion from OpenRouter, yielding content deltas as they arrive.
+    If `usage` is given it is filled in from the final usage chunk of the stream.
+    The call waits for a slot from the upstream scheduler and holds it until the stream ends,
+    and its token usage is recorded against the user once the stream is over.
+    """
     headers = {
-        "Authorization": f'Bearer {openrouter_key}',
-        "Content-Type": "application/json"
+        "Authorization": f"Bearer {openrouter_key}",
+        "Content-Type":  "application/json"
     }
+    payload = {**payload, "stream": True, "usage": {"include": True}}
+    credential = credential_id(openrouter_key)
+    usage = usage if usage is not None else {}
+    timing = {}
+    output = []
+
+    try:
+        with upstream_scheduler.slot(credential, user_id, priority, payload_cost(payload)):
+            for content in _stream_lines(credential, headers, payload, usage, timing):
+                output.append(content)
+                yield content
+    except SchedulerTimeout as e:
+        raise UpstreamError(503, str(e))
+    finally:
+        # Also runs when the client disconnects mid-stream; those tokens were still generated
+        if output or usage:
+            record_usage(user_id, chat_id, payload["model"], usage, credential == "shared",
+                         payload_text(payload), "".join(output), timing.get("first_token"))
+
+def _stream_lines(credential: str, headers: dict, payload: dict, usage: dict, timing: dict):
+    started = time.monotonic()
+    first_token = True
+    with get_http_session().post(OPENROUTER_URL, headers=headers, json=payload, stream=True) as r:
+        if not r.ok:
+            if r.status_code == 429:
+                retry_after = r.headers.get("Retry-After")
+                upstream_scheduler.backoff(credential, float(retry_after) if retry_after and retry_after.isdigit() else None)
+            raise UpstreamError(r.status_code, r.text)
 
-    # Change the messages from their DB form to a object compatible with the api
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            try:
+                data_obj = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+
+            if data_obj.get("usage"):
+                usage.update(data_obj["usage"])
+
+            choices = data_obj.get("choices") or []
+            if not choices:
+                continue
+            # Get content, handle potential None values
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                if first_token:
+                    first_token = False
+                    timing["first_token"] = time.monotonic() - started
+                    model_catalog.record_latency(payload["model"], timing["first_token"])
+                yield content
+
+def build_history(item: PromptItem, messages: APIResponse, tip: BranchTip) -> list:
+    """
+    Change the messages from their DB form to a object compatible with the api.
+    A brand new chat starts with the system prompt, which is saved along with it.
+    Rows are passed through unchanged so the history is the same bytes every turn.
+    """
     messagesInApiFormat = [
         {"role": message.get("speaker").lower(), "content": message.get("content")} for message in messages.data
     ]
 
     if len(messagesInApiFormat) == 0:
         messagesInApiFormat = [{"role": "system", "content": SYSTEM_PROMPT }]
-        supabase.table("messages") \
-            .insert({"chat_id": item.chatId, "provider_id": item.model, "content": SYSTEM_PROMPT, "speaker": "System"}) \
-            .execute()
-    print(messagesInApiFormat)
-    # return
-
-    # Determine the model to use based on web search setting
-    model_to_use = item.model
-    if item.webSearchEnabled:
-        # Use the :online suffix for web search capability
-        if not item.model.endswith(":online"):
-            model_to_use = f"{item.model}:online"
+        tip.save(item.model, SYSTEM_PROMPT, "System")
+    elif messagesInApiFormat[0]["role"] != "system":
+        # Older or imported chats without a stored system prompt still get it first
+        messagesInApiFormat.insert(0, {"role": "system", "content": SYSTEM_PROMPT })
+    return messagesInApiFormat
+
+def model_fields(model: str, webSearchEnabled: Optional[bool]) -> dict:
+    """The payload's model, plus whatever turns web search on for it (see ModelCatalog.web_search)."""
+    if webSearchEnabled:
+        return model_catalog.web_search(model)
+    return {"model": model}
+
+def stream_reply(item: PromptItem, model: str, openrouter_key: str, payload: dict, usage: Optional[dict] = None,
+                 user_id: Optional[str] = None, priority: int = INTERACTIVE, tip: Optional[BranchTip] = None,
+                 raise_errors: bool = False):
+    """
+    Stream one model's reply to the client and save it as that model's Assistant message.
+    An upstream error is saved as the reply and streamed as text, or with
+    `raise_errors` re-raised unsaved so the caller can report it separately.
+    """
+    tip = tip or branch_tip(item.chatId)
+    response = []
+    try:
+        for content in stream_completion(openrouter_key, payload, usage, user_id, priority, item.chatId):
+            response.append(content)
+            yield content
+    except UpstreamError as e:
+        logger.error(f"OpenRouter API error ({e.status_code}): {e.body}")
+        if raise_errors:
+            raise
+        error_msg = f"Error: {e.status_code} - {e.body}"
+        tip.save(model, error_msg, "Assistant")
+        yield error_msg
+        return
+    print(f'R: {"".join(response)}')
+
+    # Save the assistant's response in the database
+    tip.save(model, "".join(response), "Assistant")
+
+# Send chat
+def send_chat_prompt(item: PromptItem, user: gotrue.types.User, messages: APIResponse, usage: Optional[dict] = None,
+                     priority: int = INTERACTIVE, openrouter_key: Optional[str] = None, raise_errors: bool = False):
+    logger.info(f"Prompt: {item.prompt}")
     
-    # Actual API payload
+    openrouter_key = openrouter_key or get_openrouter_key(user)
+    tip = branch_tip(item.chatId, messages)
+    messagesInApiFormat = build_history(item, messages, tip)
+    print(messagesInApiFormat)
+
+    # Actual API payload, with a prefix the provider can serve from its prompt cache
     payload = {
-        "model": model_to_use,
-        "messages": [
-            *messagesInApiFormat,
-            {"role": "user", "content": item.prompt}
-        ],
-        "stream": True
+        **model_fields(item.model, item.webSearchEnabled),
+        "messages": build_messages(item.model, messagesInApiFormat, item.prompt)
     }
     print(payload["messages"])
 
-    supabase.table("messages") \
-        .insert({"chat_id": item.chatId, "provider_id": item.model, "content": item.prompt, "speaker": "User"}) \
-        .execute()
+    tip.save(item.model, item.prompt, "User")
     # Stream the response back to the client
-    response = []
-    with requests.post(url, headers=headers, json=payload, stream=True) as r:
-        for line in r.iter_lines(decode_unicode=True):
-            if not line or not line.startswith("data: "):
-                continue
-            data = line[len("data: "):]
-            if data == "[DONE]":
-                print(f'R: {"".join(response)}')
+    yield from stream_reply(item, item.model, openrouter_key, payload, usage, user.id, priority, tip, raise_errors)
 
-                # Save the assistant's response in the database
-                supabase.table("messages") \
-                    .insert({"chat_id": item.chatId, "provider_id": item.model, "content": "".join(response), "speaker": "Assistant"}) \
-                    .execute()
-                break
-            try:
-                data_obj = json.loads(data)
-                delta = data_obj["choices"][0]["delta"]
-
-                # Get content, handle potential None values
-                content = delta.get("content")
-                if content:
-                    # Remove the problematic encoding/decoding that was causing issues
-                    response.append(content)
-                    yield content
-            except json.JSONDecodeError:
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def send_compare_prompt(item: PromptItem, user: gotrue.types.User, messages: APIResponse, models: List[str],
+                        openrouter_key: Optional[str] = None):
+    """
+    Send one prompt to several models at once over a single event stream.
+    The history is loaded and the user message saved once, then every model
+    streams concurrently and its reply is saved with its own provider_id.
+    Events are `token` / `done` / `error` tagged with the model, then `end`.
+    """
+    logger.info(f"Compare prompt across {models}: {item.prompt}")
+
+    openrouter_key = openrouter_key or get_openrouter_key(user)
+    tip = branch_tip(item.chatId, messages)
+    messagesInApiFormat = build_history(item, messages, tip)
+    tip.save(item.model, item.prompt, "User")
+
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def run(model: str):
+        payload = {
+            **model_fields(model, item.webSearchEnabled),
+            "messages": build_messages(model, messagesInApiFormat, item.prompt)
+        }
+        reply = stream_reply(item, model, openrouter_key, payload, user_id=user.id, tip=tip, raise_errors=True)
+        try:
+            for content in reply:
+                if cancelled.is_set():
+                    break
+                events.put(sse_event("token", {"model": model, "content": content}))
+            events.put(sse_event("done", {"model": model}))
+        except Exception as e:
+            logger.error(f"Compare stream for {model} failed: {e}")
+            events.put(sse_event("error", {"model": model, "error": str(e)}))
+        finally:
+            reply.close()
+            events.put(None)
+
+    for model in models:
+        threading.Thread(target=run, args=(model,), name=f"compare-{model}", daemon=True).start()
+
+    try:
+        remaining = len(models)
+        while remaining:
+            event = events.get()
+            if event is None:
+                remaining -= 1
                 continue
+            yield event
+        yield sse_event("end", {"chatId": item.chatId})
+    finally:
+        # Client went away (or we finished): stop the other streams
+        cancelled.set()
 
-def generate_chat_title(prompt: str) -> str:
-    url = "https://openrouter.ai/api/v1/chat/completions"
+def generate_chat_title(prompt: str, user_id: Optional[str] = None) -> str:
+    url = OPENROUTER_URL
     headers = {
         "Authorization": f'Bearer {os.getenv("OPEN_ROUTER_KEY")}',
         "Content-Type": "application/json"
@@ -134,50 +354,52 @@ def generate_chat_title(prompt: str) -> str:
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        # Titles are nice-to-have, so they queue behind interactive and batch work
+        with upstream_scheduler.slot("shared", user_id, BACKGROUND, payload_cost(payload)):
+            response = get_http_session().post(url, headers=headers, json=payload)
         response.raise_for_status()
         data = response.json()
         raw = data["choices"][0]["message"]["content"] or "Untitled Chat"
+        record_usage(user_id, None, payload["model"], data.get("usage") or {}, True, prompt, raw)
         return raw.strip().strip('"')
     except Exception as e:
         logger.error(f"Error generating chat title: {str(e)}")
         return "Untitled Chat"
 
-def stream_multimodal(item: PromptItem, user: gotrue.types.User, file_field: dict):
-    api_key = None
-    if not user.is_anonymous:
+def title_chat_later(chatId: str, prompt: str, user_id: Optional[str] = None,
+                     on_title: Optional[Callable[[str], None]] = None) -> threading.Thread:
+    """
+    Title a new chat from its first prompt without holding up the turn that
+    created it. The chat keeps "New Chat" until the title is saved; clients
+    pick it up from /chat/{id}/title, and `on_title` is called with it.
+    """
+    def run():
+        title = generate_chat_title(prompt, user_id)
         try:
-            result = supabase.table("user_api_keys").select("encrypted_key").eq("user_id", user.id).execute()
-            if result.data and len(result.data) > 0:
-                encrypted_key = result.data[0]['encrypted_key']
-                api_key = encryption.decrypt_api_key(encrypted_key)
+            supabase.table("chats").update({"title": title}).eq("id", chatId).execute()
         except Exception as e:
-            logger.error(f"Failed to get user API key: {e}")
-        
-    openrouter_key = api_key or os.getenv("OPEN_ROUTER_KEY")
-    if not openrouter_key:
-        raise Exception("No API key available")
-    
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {openrouter_key}",
-        "Content-Type":  "application/json"
-    }
+            logger.error(f"Could not save chat title for chat {chatId}: {e}")
+            return
+        if on_title is not None:
+            on_title(title)
+
+    thread = threading.Thread(target=run, name=f"title-{chatId[:8]}", daemon=True)
+    thread.start()
+    return thread
+
+def stream_multimodal(item: PromptItem, user: gotrue.types.User, file_field: dict, usage: Optional[dict] = None,
+                      openrouter_key: Optional[str] = None):
+    openrouter_key = openrouter_key or get_openrouter_key(user)
+    tip = branch_tip(item.chatId)
 
     # 1) record user prompt
-    supabase.table("messages").insert({
-        "chat_id":     item.chatId,
-        "provider_id": item.model,
-        "content":     item.prompt,
-        "speaker":     "User"
-    }).execute()
-
-    # 2) build payload - ensure we use a vision-capable model
-    vision_model = get_vision_model(item.model)
-    
-    # Apply web search if enabled
-    if item.webSearchEnabled and not vision_model.endswith(":online"):
-        vision_model = f"{vision_model}:online"
+    tip.save(item.model, item.prompt, "User")
+
+    # 2) build payload - ensure we use a model that accepts this kind of file
+    needs = {"image"} if file_field["type"] == "image_url" else {"file"}
+    vision_model = model_catalog.route(item.model, needs)
+    # The reply is attributed to the model that actually wrote it
+    provider_id = base_model(vision_model)
     
     multimodal = {
         "role":    "user",
@@ -186,83 +408,52 @@ def stream_multimodal(item: PromptItem, user: gotrue.types.User, file_field: dic
             file_field
         ]
     }
-    payload = {"model": vision_model, "messages": [multimodal], "stream": True}
+    # Apply web search if enabled
+    payload = {**model_fields(vision_model, item.webSearchEnabled), "messages": [multimodal]}
 
     # 3) stream the response with better error handling
     buffer = []
     try:
-        with requests.post(url, headers=headers, json=payload, stream=True) as r:
-            if not r.ok:
-                # Get the actual error message from OpenRouter
-                error_text = r.text
-                logger.error(f"OpenRouter API error ({r.status_code}): {error_text}")
-                error_msg = f"Error: {r.status_code} - {error_text}"
-                supabase.table("messages").insert({
-                    "chat_id":     item.chatId,
-                    "provider_id": item.model,
-                    "content":     error_msg,
-                    "speaker":     "Assistant"
-                }).execute()
-                yield error_msg
-                return
-                
-            for line in r.iter_lines(decode_unicode=True):
-                if not line.startswith("data: "):
-                    continue
-                chunk = line[len("data: "):]
-                if chunk == "[DONE]":
-                    break
-                try:
-                    delta = json.loads(chunk)["choices"][0]["delta"].get("content")
-                    if delta:
-                        buffer.append(delta)
-                        yield delta
-                except Exception as e:
-                    logger.error(f"Error parsing stream chunk: {e}")
-                    continue
+        for delta in stream_completion(openrouter_key, payload, usage, user.id, chat_id=item.chatId):
+            buffer.append(delta)
+            yield delta
+    except UpstreamError as e:
+        # Get the actual error message from OpenRouter
+        logger.error(f"OpenRouter API error ({e.status_code}): {e.body}")
+        error_msg = f"Error: {e.status_code} - {e.body}"
+        tip.save(provider_id, error_msg, "Assistant")
+        yield error_msg
+        return
     except Exception as e:
         logger.error(f"Error in stream_multimodal: {str(e)}")
         error_msg = f"Error processing file: {str(e)}"
-        supabase.table("messages").insert({
-            "chat_id":     item.chatId,
-            "provider_id": item.model,
-            "content":     error_msg,
-            "speaker":     "Assistant"
-        }).execute()
+        tip.save(provider_id, error_msg, "Assistant")
         yield error_msg
         return
 
     # 4) record assistant reply
     full = "".join(buffer)
     if full:  # Only save if we got content
-        supabase.table("messages").insert({
-            "chat_id":     item.chatId,
-            "provider_id": item.model,
-            "content":     full,
-            "speaker":     "Assistant"
-        }).execute()
-
-def get_vision_model(requested_model: str) -> str:
-    vision_models = {
-        "openai/gpt-4": "openai/gpt-4-vision-preview",
-        "openai/gpt-3.5-turbo": "openai/gpt-4-vision-preview",  # Fallback to GPT-4V
-        "anthropic/claude-3-sonnet": "anthropic/claude-3-sonnet",  # Already supports vision
-        "anthropic/claude-3-haiku": "anthropic/claude-3-haiku",    # Already supports vision
-        "google/gemini-pro": "google/gemini-pro-vision",
-    }
-    return vision_models.get(requested_model, "openai/gpt-4-vision-preview")
+        tip.save(provider_id, full, "Assistant")
 
-def send_image_prompt(item: PromptItem, user: gotrue.types.User, file_bytes: bytes, content_type: str):
+def send_image_prompt(item: PromptItem, user: gotrue.types.User, file_bytes: bytes, content_type: str,
+                      openrouter_key: Optional[str] = None):
     b64 = base64.b64encode(file_bytes).decode("utf-8")
     data_url = f"data:{content_type};base64,{b64}"
     file_field = {"type": "image_url", "image_url": {"url": data_url}}
-    return stream_multimodal(item, user, file_field)
+    return stream_multimodal(item, user, file_field, openrouter_key=openrouter_key)
 
-def send_pdf_prompt(item: PromptItem, user: gotrue.types.User, file_bytes: bytes, content_type: str):
+def send_pdf_prompt(item: PromptItem, user: gotrue.types.User, file_bytes: bytes, content_type: str, filename: str = "document.pdf",
+                    openrouter_key: Optional[str] = None):
     """
-    Handle PDF files by converting to text first, since most LLMs don't support PDF directly.
-    We'll use a text-based approach similar to CSV handling.
+    Send the PDF as a file part to a model that accepts files. If the catalogue
+    has no such model, fall back to a text-based approach similar to CSV handling.
     """
+    if model_catalog.capable({"file"}):
+        b64 = base64.b64encode(file_bytes).decode("utf-8")
+        file_field = {"type": "file", "file": {"filename": filename, "file_data": f"data:{content_type};base64,{b64}"}}
+        return stream_multimodal(item, user, file_field, openrouter_key=openrouter_key)
+
     try:
         # For now, we'll treat PDFs as text files and use the text approach
         # In the future, you could integrate a PDF parser like PyPDF2 or pdfplumber
@@ -271,7 +462,7 @@ def send_pdf_prompt(item: PromptItem, user: gotrue.types.User, file_bytes: bytes
         enhanced_prompt = f"""
             {item.prompt}
 
-            I've received a PDF file named "{getattr(item, 'filename', 'document.pdf')}". 
+            I've received a PDF file named "{filename}". 
             Unfortunately, I cannot directly read PDF files in this format. 
 
             To help you with this PDF, please:
@@ -283,107 +474,53 @@ def send_pdf_prompt(item: PromptItem, user: gotrue.types.User, file_bytes: bytes
         """
         
         # Use the regular chat prompt function with enhanced text
-        return send_text_prompt(item, user, enhanced_prompt)
+        return send_text_prompt(item, user, enhanced_prompt, openrouter_key=openrouter_key)
         
     except Exception as e:
         logger.error(f"Error processing PDF file: {str(e)}")
         error_msg = f"Error processing PDF file: {str(e)}"
-        return send_text_prompt(item, user, error_msg)
+        return send_text_prompt(item, user, error_msg, openrouter_key=openrouter_key)
 
-def send_text_prompt(item: PromptItem, user: gotrue.types.User, prompt_text: str):
+def send_text_prompt(item: PromptItem, user: gotrue.types.User, prompt_text: str, usage: Optional[dict] = None,
+                     openrouter_key: Optional[str] = None):
     """
     (used for CSV and PDF fallbacks)
     """
-    api_key = None
-    if not user.is_anonymous:
-        try:
-            result = supabase.table("user_api_keys").select("encrypted_key").eq("user_id", user.id).execute()
-            if result.data and len(result.data) > 0:
-                encrypted_key = result.data[0]['encrypted_key']
-                api_key = encryption.decrypt_api_key(encrypted_key)
-        except Exception as e:
-            logger.error(f"Failed to get user API key: {e}")
-        
-    openrouter_key = api_key or os.getenv("OPEN_ROUTER_KEY")
-    if not openrouter_key:
-        raise Exception("No API key available")
-    
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {openrouter_key}",
-        "Content-Type":  "application/json"
-    }
+    openrouter_key = openrouter_key or get_openrouter_key(user)
+    tip = branch_tip(item.chatId)
 
     # Record user prompt
-    supabase.table("messages").insert({
-        "chat_id":     item.chatId,
-        "provider_id": item.model,
-        "content":     item.prompt + " [File uploaded]",
-        "speaker":     "User"
-    }).execute()
-
-    # Determine the model to use based on web search setting
-    model_to_use = item.model
-    if item.webSearchEnabled and not item.model.endswith(":online"):
-        model_to_use = f"{item.model}:online"
-    
-    # Build payload for text-based analysis
+    tip.save(item.model, item.prompt + " [File uploaded]", "User")
+
+    # Build payload for text-based analysis, with web search if enabled
     payload = {
-        "model": model_to_use, 
+        **model_fields(item.model, item.webSearchEnabled),
         "messages": [
             {"role": "user", "content": prompt_text}
-        ], 
-        "stream": True
+        ]
     }
 
     # Stream the response
     buffer = []
     try:
-        with requests.post(url, headers=headers, json=payload, stream=True) as r:
-            if not r.ok:
-                error_text = r.text
-                logger.error(f"OpenRouter API error ({r.status_code}): {error_text}")
-                error_msg = f"Error: {r.status_code} - {error_text}"
-                supabase.table("messages").insert({
-                    "chat_id":     item.chatId,
-                    "provider_id": item.model,
-                    "content":     error_msg,
-                    "speaker":     "Assistant"
-                }).execute()
-                yield error_msg
-                return
-                
-            for line in r.iter_lines(decode_unicode=True):
-                if not line.startswith("data: "):
-                    continue
-                chunk = line[len("data: "):]
-                if chunk == "[DONE]":
-                    break
-                try:
-                    delta = json.loads(chunk)["choices"][0]["delta"].get("content")
-                    if delta:
-                        buffer.append(delta)
-                        yield delta
-                except Exception:
-                    continue
+        for delta in stream_completion(openrouter_key, payload, usage, user.id, chat_id=item.chatId):
+            buffer.append(delta)
+            yield delta
+    except UpstreamError as e:
+        # Get the actual error message from OpenRouter
+        logger.error(f"OpenRouter API error ({e.status_code}): {e.body}")
+        error_msg = f"Error: {e.status_code} - {e.body}"
+        tip.save(item.model, error_msg, "Assistant")
+        yield error_msg
+        return
     except Exception as e:
         logger.error(f"Error in send_text_prompt: {str(e)}")
         error_msg = f"Error processing request: {str(e)}"
-        supabase.table("messages").insert({
-            "chat_id":     item.chatId,
-            "provider_id": item.model,
-            "content":     error_msg,
-            "speaker":     "Assistant"
-        }).execute()
+        tip.save(item.model, error_msg, "Assistant")
         yield error_msg
         return
 
     # Record assistant reply
     full = "".join(buffer)
     if full:
-        supabase.table("messages").insert({
-            "chat_id":     item.chatId,
-            "provider_id": item.model,
-            "content":     full,
-            "speaker":     "Assistant"
-        }).execute()
\ No newline at end of file
+        tip.save(item.model, full, "Assistant")
\ No newline at end of file
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any
+
+import os
+import threading
+
+# Default budget for all cached histories in this worker (bytes of message content)
+DEFAULT_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Fixed per-row cost on top of the content so tiny messages still count
+ROW_OVERHEAD = 128
+
+def _row_size(row: Dict[str, Any]) -> int:
+    return len((row.get("content") or "").encode("utf-8")) + ROW_OVERHEAD
+
+class ChatHistoryCache:
+    """
+    Per-chat message history kept in memory, bounded by total bytes and
+    evicted least-recently-used first. Rows are the chat's current branch in
+    created_at order, which for a fork includes rows of the chat it came from.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Return a copy of the cached rows for a chat, or None on a miss."""
+        with self._lock:
+            rows = self._entries.get(chat_id)
+            if rows is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return list(rows)
+
+    def put(self, chat_id: str, rows: List[Dict[str, Any]]):
+        """Replace the cached history for a chat with freshly loaded rows."""
+        with self._lock:
+            self._drop(chat_id)
+            self._entries[chat_id] = list(rows)
+            self._sizes[chat_id] = sum(_row_size(row) for row in rows)
+            self._bytes += self._sizes[chat_id]
+            self._evict()
+
+    def append(self, chat_id: str, row: Dict[str, Any]):
+        """Add a newly written row. Chats that aren't cached are left alone."""
+        with self._lock:
+            rows = self._entries.get(chat_id)
+            if rows is None:
+                return
+            rows.append(row)
+            size = _row_size(row)
+            self._sizes[chat_id] += size
+            self._bytes += size
+            self._entries.move_to_end(chat_id)
+            self._evict()
+
+    def invalidate(self, chat_id: str):
+        with self._lock:
+            self._drop(chat_id)
+
+    def is_current(self, chat_id: str, latest: Optional[Dict[str, Any]]) -> bool:
+        """
+        Check the cached history against the newest row in the database.
+        `latest` is the result of a one-row probe (id) or None
+        when the chat has no messages yet.
+        """
+        with self._lock:
+            rows = self._entries.get(chat_id)
+            if rows is None:
+                return False
+            if latest is None:
+                # No rows of its own yet: current if everything cached is inherited from a fork
+                return all(row.get("chat_id") != chat_id for row in rows)
+            if not rows:
+                return False
+            # Ids are uuids, so they alone identify the row; created_at strings differ in
+            # formatting between Python's isoformat() and what Postgres returns
+            return rows[-1].get("id") == latest.get("id")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "chats": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _drop(self, chat_id: str):
+        if chat_id in self._entries:
+            del self._entries[chat_id]
+            self._bytes -= self._sizes.pop(chat_id)
+
+    def _evict(self):
+        # Always keep the most recently used chat, even if it alone is over budget
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            chat_id, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(chat_id)
+
+history_cache = ChatHistoryCache()
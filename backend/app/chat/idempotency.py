@@ -0,0 +1,187 @@
+from typing import Optional, Dict, Any, Iterator, List, Tuple, Union, Callable
+
+from app.ttl_store import TTLStore
+
+import os
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Long enough to cover a client retrying a dropped stream, not to keep replies around
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "5000"))
+# How long a duplicate waits for the original request to start streaming
+ATTACH_TIMEOUT = float(os.getenv("IDEMPOTENCY_ATTACH_TIMEOUT", "60"))
+
+PENDING = "pending"
+STREAMING = "streaming"
+DONE = "done"
+FAILED = "failed"
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key was reused for a request with a different body."""
+
+def fingerprint(*parts: Union[str, bytes, None]) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            part = b""
+        digest.update(part if isinstance(part, bytes) else part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class IdempotentRequest:
+    """
+    The outcome of the first request seen with a given key. A streamed reply is
+    produced by a background thread and every chunk is kept, so concurrent
+    duplicates follow the same generation live and later ones replay it. The
+    generation runs to completion even if the original client disconnects.
+    Once it has, the chunks are joined into one string so a finished reply
+    isn't held as thousands of small token strings.
+    A stream that fails before producing anything is handed to `on_failure`
+    instead, since there's nothing to replay.
+    """
+
+    def __init__(self, request_fingerprint: str,
+                 on_failure: Optional[Callable[["IdempotentRequest", Any], None]] = None):
+        self.fingerprint = request_fingerprint
+        self.on_failure = on_failure
+        self.state = PENDING
+        self.chunks: List[Any] = []
+        # The whole reply once it's complete; chunks is emptied then
+        self.body: Union[str, bytes, None] = None
+        self.headers: Dict[str, str] = {}
+        self.media_type: Optional[str] = None
+        self.outcome: Any = None
+        self.store_key: Optional[Tuple[str, str, str]] = None
+        self._cond = threading.Condition()
+
+    def stream(self, chunks: Iterator, headers: Dict[str, str], media_type: str) -> Iterator:
+        """Start producing the reply in the background and return a follower for the caller."""
+        with self._cond:
+            self.headers = dict(headers)
+            self.media_type = media_type
+            self.state = STREAMING
+            self._cond.notify_all()
+        threading.Thread(target=self._produce, args=(chunks,), name="idempotent-stream", daemon=True).start()
+        return self.follow()
+
+    def fail(self, outcome: Any):
+        """Record a reply that wasn't streamed (an error) so waiting duplicates get the same one."""
+        with self._cond:
+            self.outcome = outcome
+            self.state = FAILED
+            self._cond.notify_all()
+
+    def wait_started(self, timeout: float = ATTACH_TIMEOUT) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.state != PENDING, timeout)
+
+    def follow(self) -> Iterator:
+        """
+        Every chunk so far, then new ones as they're produced, until the reply is
+        complete. A stream that failed before its first chunk fails its followers too.
+        """
+        sent = 0
+        # Length of everything yielded, to pick up where we were once the chunks are joined
+        position = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: sent < len(self.chunks) or self.state in (DONE, FAILED))
+                if self.body is not None:
+                    new = [self.body[position:]] if position < len(self.body) else []
+                else:
+                    new = self.chunks[sent:]
+                state = self.state
+            sent += len(new)
+            position += sum(len(chunk) for chunk in new)
+            yield from new
+            if state == FAILED and isinstance(self.outcome, Exception):
+                raise self.outcome
+            if state in (DONE, FAILED):
+                return
+
+    def _produce(self, chunks: Iterator):
+        error = None
+        try:
+            for chunk in chunks:
+                with self._cond:
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except Exception as e:
+            logger.error(f"Idempotent stream failed: {e}")
+            error = e
+        finally:
+            if error is not None and not self.chunks and self.on_failure is not None:
+                self.on_failure(self, error)
+            else:
+                with self._cond:
+                    self._join_chunks()
+                    self.state = DONE
+                    self._cond.notify_all()
+
+    def _join_chunks(self):
+        # Only a reply of all text or all bytes can be joined
+        if self.chunks and all(isinstance(chunk, str) for chunk in self.chunks):
+            self.body, self.chunks = "".join(self.chunks), []
+        elif self.chunks and all(isinstance(chunk, bytes) for chunk in self.chunks):
+            self.body, self.chunks = b"".join(self.chunks), []
+
+class IdempotencyStore:
+    """
+    Requests by (route, user, Idempotency-Key), kept for IDEMPOTENCY_TTL seconds.
+    Keys are scoped to the user, so two callers who happen to send the same key
+    and body never share a response.
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_entries: int = MAX_ENTRIES):
+        self._requests = TTLStore(ttl, max_entries)
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.attached = 0
+        self.replayed = 0
+
+    def begin(self, scope: str, user_id: str, key: str, request_fingerprint: str) -> Tuple[IdempotentRequest, bool]:
+        """
+        Claim a key. Returns (request, True) if the caller is first and should run
+        the request, or the existing (request, False) for a duplicate.
+        """
+        store_key = (scope, user_id, key)
+        entry, created = self._requests.get_or_create(
+            store_key, lambda: IdempotentRequest(request_fingerprint, self.abandon)
+        )
+        if created:
+            entry.store_key = store_key
+        if not created and entry.fingerprint != request_fingerprint:
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+        with self._lock:
+            if created:
+                self.executed += 1
+            elif entry.state == DONE:
+                self.replayed += 1
+            else:
+                self.attached += 1
+        return entry, created
+
+    def abandon(self, entry: IdempotentRequest, outcome: Any):
+        """
+        Forget a key whose request failed before streaming anything, so a retry
+        runs it again. Duplicates already waiting on it get the same outcome.
+        """
+        entry.fail(outcome)
+        with self._lock:
+            if self._requests.get(entry.store_key) is entry:
+                self._requests.pop(entry.store_key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries":  len(self._requests),
+                "executed": self.executed,
+                "attached": self.attached,
+                "replayed": self.replayed,
+            }
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,50 @@
+from typing import Dict, Any, List, Union
+
+from .catalog import base_model
+
+# OpenRouter passes cache_control breakpoints through to these providers;
+# the others (OpenAI, DeepSeek, ...) cache matching prefixes automatically
+CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini")
+
+# Below roughly 1024 tokens providers won't cache a prefix, so don't ask them to
+MIN_CACHEABLE_CHARS = 4096
+
+def supports_cache_control(model: str) -> bool:
+    return base_model(model).startswith(CACHE_CONTROL_PREFIXES)
+
+def content_text(content: Union[str, List[Dict[str, Any]], None]) -> str:
+    """The text of a message whether its content is a string or a list of parts."""
+    if isinstance(content, list):
+        return "".join(part.get("text") or "" for part in content if part.get("type") == "text")
+    return content or ""
+
+def _with_cache_control(message: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "role": message["role"],
+        "content": [{"type": "text", "text": content_text(message["content"]), "cache_control": {"type": "ephemeral"}}]
+    }
+
+def build_messages(model: str, history: List[Dict[str, Any]], prompt: str) -> List[Dict[str, Any]]:
+    """
+    The messages for one completion: the chat's history as stored (system
+    prompt first) followed by the new prompt. Nothing in the history is
+    rewritten per turn, so everything before the prompt is byte-for-byte the
+    previous turn's payload plus that turn's exchange, which is what provider
+    prompt caches match on.
+
+    For providers that need explicit breakpoints, the system prompt and the
+    end of the history are marked. This turn then reads the cache written at
+    the end of the last one and writes a new entry for the next turn.
+    """
+    messages = [*history, {"role": "user", "content": prompt}]
+    if not supports_cache_control(model):
+        return messages
+
+    breakpoints = []
+    if history and history[0]["role"] == "system":
+        breakpoints.append(0)
+    if len(history) > 1 and sum(len(content_text(m["content"])) for m in history) >= MIN_CACHEABLE_CHARS:
+        breakpoints.append(len(history) - 1)
+    for index in breakpoints:
+        messages[index] = _with_cache_control(messages[index])
+    return messages
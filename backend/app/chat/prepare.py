@@ -0,0 +1,87 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+from postgrest.base_request_builder import APIResponse
+
+from app.ttl_store import TTLStore
+from app.clients import warm_http_session, claim_warmup
+from app.auth.supabase_client import supabase
+from .functions import get_chat_messages, get_openrouter_key, OPENROUTER_URL
+from .history import history_cache
+from .catalog import model_catalog
+
+import os
+import secrets
+import threading
+import logging
+import gotrue
+
+logger = logging.getLogger(__name__)
+
+PREPARE_TTL = float(os.getenv("PREPARE_TOKEN_TTL", "60"))
+
+@dataclass
+class PreparedChat:
+    """What /chat/prepare resolved ahead of a prompt, for the /chat that follows."""
+    user: gotrue.types.User
+    chat_id: Optional[str]
+    chat_exists: bool
+    openrouter_key: str
+    messages: Optional[List[Dict[str, Any]]]
+
+    def history(self) -> Optional[APIResponse]:
+        """
+        The prepared history, if it's still what this worker has cached. Writes
+        through another worker since the prepare go unnoticed, which is why
+        tokens only live for PREPARE_TTL seconds.
+        """
+        if self.messages is None:
+            return None
+        cached = history_cache.get(self.chat_id)
+        if cached is None or [row.get("id") for row in cached] != [row.get("id") for row in self.messages]:
+            return None
+        return APIResponse(data=cached, count=None)
+
+prepared_chats = TTLStore(PREPARE_TTL)
+
+def warm_upstream():
+    """Refresh pooled connections to OpenRouter in the background, at most once per WARM_INTERVAL."""
+    if claim_warmup(OPENROUTER_URL):
+        threading.Thread(target=warm_http_session, args=(OPENROUTER_URL,), name="warm-upstream", daemon=True).start()
+
+def prepare_chat(user: gotrue.types.User, chat_id: Optional[str], model: Optional[str] = None) -> str:
+    """
+    Do the per-turn lookups of /chat ahead of time: decrypt the user's key,
+    check the chat and load its history into the cache (rehydrating it if it
+    was archived), and refresh the model catalogue. Returns a single-use token.
+    """
+    warm_upstream()
+    if model:
+        model_catalog.get(model)
+
+    chat_exists = False
+    messages = None
+    if chat_id:
+        res = supabase.table("chats").select("id, user_id").eq("id", chat_id).execute()
+        chat_exists = bool(res.data) and res.data[0].get("user_id") == user.id
+        if chat_exists:
+            messages = get_chat_messages(chat_id).data
+
+    token = secrets.token_urlsafe(24)
+    prepared_chats.set(token, PreparedChat(
+        user=user,
+        chat_id=chat_id,
+        chat_exists=chat_exists,
+        openrouter_key=get_openrouter_key(user),
+        messages=messages,
+    ))
+    return token
+
+def take_prepared(token: Optional[str], chat_id: Optional[str]) -> Optional[PreparedChat]:
+    """Redeem a prepare token. Tokens are single use and only valid for the chat they were made for."""
+    if not token:
+        return None
+    prepared = prepared_chats.pop(token)
+    if prepared is None or (prepared.chat_id or None) != (chat_id or None):
+        return None
+    return prepared
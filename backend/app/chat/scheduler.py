@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List
+
+import os
+import time
+import heapq
+import hashlib
+import itertools
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lowest value is served first
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch", BACKGROUND: "background"}
+
+SHARED_CONCURRENCY = int(os.getenv("SHARED_KEY_CONCURRENCY", "16"))
+USER_KEY_CONCURRENCY = int(os.getenv("USER_KEY_CONCURRENCY", "4"))
+QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "60"))
+DEFAULT_RATE_LIMIT_BACKOFF = 2.0
+
+class SchedulerTimeout(Exception):
+    """A request waited longer than UPSTREAM_QUEUE_TIMEOUT for an upstream slot."""
+
+def credential_id(openrouter_key: str) -> str:
+    """Queue name for a key. Keys are hashed so they never end up in metrics or logs."""
+    if openrouter_key == os.getenv("OPEN_ROUTER_KEY"):
+        return "shared"
+    return "user:" + hashlib.sha256(openrouter_key.encode()).hexdigest()[:12]
+
+def prompt_cost(text: str) -> float:
+    """Rough relative cost of a request, so short turns get earlier virtual start times."""
+    return 1.0 + len(text) / 4000
+
+@dataclass(order=True)
+class _Ticket:
+    priority: int
+    start_tag: float
+    seq: int
+    user_id: str = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    granted: threading.Event = field(compare=False, default_factory=threading.Event)
+    abandoned: bool = field(compare=False, default=False)
+
+class _Lane:
+    """Waiting requests and in-flight count for one credential."""
+
+    def __init__(self, credential: str, limit: int):
+        self.credential = credential
+        self.limit = limit
+        self.active = 0
+        self.waiting: List[_Ticket] = []
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {}
+        self.paused_until = 0.0
+
+    def depth(self) -> int:
+        return sum(1 for ticket in self.waiting if not ticket.abandoned)
+
+class UpstreamScheduler:
+    """
+    Gatekeeper for upstream completion calls. Each credential (the shared server
+    key, or a user's own key) gets a lane with a concurrency limit. Inside a lane
+    requests are ordered by priority class and then by start-time fair queueing
+    across users, so a user who sends a burst only delays their own later
+    requests instead of everyone's.
+    """
+
+    def __init__(self, shared_limit: int = SHARED_CONCURRENCY, user_limit: int = USER_KEY_CONCURRENCY,
+                 queue_timeout: float = QUEUE_TIMEOUT):
+        self.shared_limit = shared_limit
+        self.user_limit = user_limit
+        self.queue_timeout = queue_timeout
+        self._lanes: Dict[str, _Lane] = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waits: Dict[int, Dict[str, float]] = {
+            priority: {"count": 0, "total": 0.0, "max": 0.0} for priority in PRIORITY_NAMES
+        }
+        self.timeouts = 0
+
+    @contextmanager
+    def slot(self, credential: str, user_id: Optional[str], priority: int = INTERACTIVE,
+             cost: float = 1.0, weight: float = 1.0):
+        """Block until this request may call upstream, and hold the slot for the duration."""
+        lane, ticket = self._enqueue(credential, user_id or "anonymous", priority, cost, weight)
+        self._dispatch(lane)
+
+        if not ticket.granted.wait(self.queue_timeout):
+            with self._lock:
+                # It may have been granted between the timeout and taking the lock
+                if not ticket.granted.is_set():
+                    ticket.abandoned = True
+                    self.timeouts += 1
+                    raise SchedulerTimeout(f"Timed out waiting for an upstream slot on {credential}")
+
+        self._record_wait(ticket)
+        try:
+            yield
+        finally:
+            with self._lock:
+                lane.active -= 1
+            self._dispatch(lane)
+
+    def backoff(self, credential: str, seconds: Optional[float] = None):
+        """Hold new grants on a credential after the provider rate limited it."""
+        seconds = seconds if seconds is not None else DEFAULT_RATE_LIMIT_BACKOFF
+        with self._lock:
+            lane = self._lane(credential)
+            lane.paused_until = max(lane.paused_until, time.monotonic() + seconds)
+        logger.warning(f"Upstream rate limited {credential}, pausing it for {seconds}s")
+        threading.Timer(seconds, self._dispatch, args=(lane,)).start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lanes = {
+                name: {
+                    "queued": lane.depth(),
+                    "active": lane.active,
+                    "limit": lane.limit,
+                    "paused": lane.paused_until > time.monotonic(),
+                }
+                for name, lane in self._lanes.items()
+                if lane.active or lane.waiting or name == "shared"
+            }
+            waits = {
+                PRIORITY_NAMES[priority]: {
+                    "count": wait["count"],
+                    "avg_ms": round(wait["total"] / wait["count"] * 1000, 1) if wait["count"] else 0.0,
+                    "max_ms": round(wait["max"] * 1000, 1),
+                }
+                for priority, wait in self._waits.items()
+            }
+            return {"lanes": lanes, "wait": waits, "timeouts": self.timeouts}
+
+    def _lane(self, credential: str) -> _Lane:
+        # Caller holds self._lock
+        lane = self._lanes.get(credential)
+        if lane is None:
+            lane = _Lane(credential, self.shared_limit if credential == "shared" else self.user_limit)
+            self._lanes[credential] = lane
+        return lane
+
+    def _enqueue(self, credential: str, user_id: str, priority: int, cost: float, weight: float):
+        with self._lock:
+            lane = self._lane(credential)
+            start_tag = max(lane.virtual_time, lane.last_finish.get(user_id, 0.0))
+            lane.last_finish[user_id] = start_tag + cost / weight
+            ticket = _Ticket(priority, start_tag, next(self._seq), user_id, time.monotonic())
+            heapq.heappush(lane.waiting, ticket)
+            return lane, ticket
+
+    def _dispatch(self, lane: _Lane):
+        with self._lock:
+            now = time.monotonic()
+            if lane.paused_until > now:
+                return
+            while lane.waiting and lane.active < lane.limit:
+                ticket = heapq.heappop(lane.waiting)
+                if ticket.abandoned:
+                    continue
+                lane.active += 1
+                lane.virtual_time = max(lane.virtual_time, ticket.start_tag)
+                ticket.granted.set()
+            if not lane.waiting and not lane.active:
+                # Idle lane: forget per-user tags so they don't grow forever
+                lane.last_finish.clear()
+                # and drop user-key lanes entirely (a rate-limit pause is kept until it runs out)
+                if lane.credential != "shared" and lane.paused_until <= now and self._lanes.get(lane.credential) is lane:
+                    del self._lanes[lane.credential]
+
+    def _record_wait(self, ticket: _Ticket):
+        waited = time.monotonic() - ticket.enqueued_at
+        with self._lock:
+            wait = self._waits[ticket.priority]
+            wait["count"] += 1
+            wait["total"] += waited
+            wait["max"] = max(wait["max"], waited)
+
+upstream_scheduler = UpstreamScheduler()
@@ -0,0 +1,215 @@
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, Tuple
+
+from app.auth.supabase_client import supabase_admin
+from .writer import WriteBehindQueue, utc_now
+from .catalog import base_model
+from .scheduler import credential_id
+
+import os
+import time
+import uuid
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tokens per user per UTC day on the shared server key; 0 means no limit
+DAILY_TOKEN_QUOTA = int(os.getenv("DAILY_TOKEN_QUOTA", "0"))
+
+# How often a user's counter is re-read from usage_daily, to pick up other workers' usage
+QUOTA_SYNC_INTERVAL = float(os.getenv("QUOTA_SYNC_INTERVAL", "30"))
+
+# Rough characters-per-token ratio for when a provider doesn't report usage
+CHARS_PER_TOKEN = 4
+
+# Batches mix users (and guests), so they're written past RLS; usage_daily is
+# rolled up from them by a trigger
+usage_writer = WriteBehindQueue("usage_events", key="user_id", client=supabase_admin)
+
+class QuotaExceeded(Exception):
+    """The user has used up today's allowance on the shared key."""
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN) if text else 0
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+class UsageQuota:
+    """
+    In-memory running total of each user's shared-key tokens for the current
+    day. A user's counter is seeded from the usage_daily rollup the first time
+    they're seen each day and re-read from it every QUOTA_SYNC_INTERVAL seconds,
+    so usage through other workers counts too; in between, every check and
+    update is local.
+    """
+
+    def __init__(self, daily_limit: int = DAILY_TOKEN_QUOTA, sync_interval: float = QUOTA_SYNC_INTERVAL):
+        self.daily_limit = daily_limit
+        self.sync_interval = sync_interval
+        self._used: Dict[Tuple[str, str], int] = {}
+        self._synced_at: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def check(self, user_id: str, openrouter_key: str):
+        """
+        Raise QuotaExceeded if the user can't start another request today on the
+        key the request will use. Requests on the user's own key are never limited.
+        """
+        if not self.daily_limit or credential_id(openrouter_key) != "shared":
+            return
+        used = self._counter(user_id)
+        if used >= self.daily_limit:
+            raise QuotaExceeded(
+                f"Daily limit of {self.daily_limit} tokens on the shared key reached. Add your own OpenRouter key to keep going."
+            )
+
+    def add(self, user_id: str, tokens: int):
+        if not self.daily_limit:
+            return
+        key = (user_id, _today())
+        self._counter(user_id)
+        with self._lock:
+            self._used[key] = self._used.get(key, 0) + tokens
+
+    def used(self, user_id: str) -> int:
+        return self._counter(user_id) if self.daily_limit else 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            today = _today()
+            return {
+                "daily_limit": self.daily_limit,
+                "users_today": sum(1 for (_, day) in self._used if day == today),
+            }
+
+    def _counter(self, user_id: str) -> int:
+        key = (user_id, _today())
+        with self._lock:
+            if key in self._used and time.monotonic() - self._synced_at[key] < self.sync_interval:
+                return self._used[key]
+            if key not in self._used:
+                # New day: drop yesterday's counters
+                for stale in [k for k in self._used if k[1] != key[1]]:
+                    del self._used[stale]
+                    self._synced_at.pop(stale, None)
+            # Other requests keep using the current value while this one re-reads it
+            self._synced_at[key] = time.monotonic()
+
+        loaded = self._load(user_id, key[1])
+        with self._lock:
+            # The rollup can lag this worker's own queued events, so never count down
+            self._used[key] = max(self._used.get(key, 0), loaded)
+            return self._used[key]
+
+    def _load(self, user_id: str, day: str) -> int:
+        # Keeps the current count if the rollup can't be read
+        if not supabase_admin.configured:
+            return 0
+        try:
+            result = supabase_admin.table("usage_daily") \
+                .select("shared_tokens") \
+                .eq("user_id", user_id) \
+                .eq("day", day) \
+                .execute()
+            return sum(row.get("shared_tokens") or 0 for row in result.data or [])
+        except Exception as e:
+            logger.error(f"Failed to load today's usage for {user_id}: {e}")
+            return 0
+
+usage_quota = UsageQuota()
+
+class PromptCacheStats:
+    """
+    Per-model share of prompt tokens served from the provider's prompt cache,
+    and time to first token for requests that did and didn't hit it.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, prompt_tokens: int, cached_tokens: int, cache_write_tokens: int,
+               first_token: Optional[float]):
+        hit = cached_tokens > 0
+        with self._lock:
+            entry = self._models.setdefault(base_model(model), {
+                "requests": 0, "hits": 0, "prompt_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0,
+                "hit_ttft": 0.0, "hit_ttft_count": 0, "miss_ttft": 0.0, "miss_ttft_count": 0,
+            })
+            entry["requests"] += 1
+            entry["hits"] += hit
+            entry["prompt_tokens"] += prompt_tokens
+            entry["cached_tokens"] += cached_tokens
+            entry["cache_write_tokens"] += cache_write_tokens
+            if first_token is not None:
+                prefix = "hit" if hit else "miss"
+                entry[f"{prefix}_ttft"] += first_token
+                entry[f"{prefix}_ttft_count"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        def avg_ms(total, count):
+            return round(total / count * 1000, 1) if count else None
+
+        with self._lock:
+            return {
+                model: {
+                    "requests":           entry["requests"],
+                    "hit_rate":           round(entry["hits"] / entry["requests"], 3),
+                    "prompt_tokens":      entry["prompt_tokens"],
+                    "cached_tokens":      entry["cached_tokens"],
+                    "cache_write_tokens": entry["cache_write_tokens"],
+                    "cached_ratio":       round(entry["cached_tokens"] / entry["prompt_tokens"], 3) if entry["prompt_tokens"] else 0.0,
+                    "ttft_hit_ms":        avg_ms(entry["hit_ttft"], entry["hit_ttft_count"]),
+                    "ttft_miss_ms":       avg_ms(entry["miss_ttft"], entry["miss_ttft_count"]),
+                }
+                for model, entry in self._models.items()
+            }
+
+prompt_cache_stats = PromptCacheStats()
+
+def record_usage(user_id: Optional[str], chat_id: Optional[str], model: str, usage: Dict[str, Any],
+                 shared_key: bool, prompt_text: str = "", completion_text: str = "",
+                 first_token: Optional[float] = None):
+    """
+    Log one upstream call to usage_events and count it against the user's quota.
+    Uses the provider's usage numbers when the stream reported them, otherwise
+    estimates from the prompt and completion text.
+    """
+    estimated = not usage.get("total_tokens")
+    if estimated:
+        prompt_tokens = estimate_tokens(prompt_text)
+        completion_tokens = estimate_tokens(completion_text)
+    else:
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    cached_tokens = prompt_details.get("cached_tokens") or 0
+    if not estimated:
+        prompt_cache_stats.record(model, prompt_tokens, cached_tokens,
+                                  prompt_details.get("cache_write_tokens") or 0, first_token)
+
+    if shared_key and user_id:
+        usage_quota.add(user_id, prompt_tokens + completion_tokens)
+    if not user_id or not supabase_admin.configured:
+        return
+
+    row = {
+        "id":                str(uuid.uuid4()),
+        "user_id":           user_id,
+        "chat_id":           chat_id,
+        "model":             model,
+        "prompt_tokens":     prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens":     cached_tokens,
+        "cost":              usage.get("cost"),
+        "estimated":         estimated,
+        "shared_key":        shared_key,
+        "created_at":        utc_now()
+    }
+    try:
+        usage_writer.enqueue(row)
+    except Exception as e:
+        # Accounting must never break the chat itself
+        logger.error(f"Failed to record usage for {user_id}: {e}")
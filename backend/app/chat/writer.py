@@ -0,0 +1,270 @@
+from collections import deque, Counter
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, Tuple, Callable
+
+from postgrest.exceptions import APIError
+
+from app.auth.supabase_client import supabase, LazySupabaseClient
+from .history import history_cache
+
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "50")) / 1000
+BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+MAX_BACKLOG = int(os.getenv("WRITE_BEHIND_MAX_BACKLOG", "10000"))
+
+# Only an unreachable or overloaded database is worth retrying: connection
+# exceptions (08), rollbacks (40), insufficient resources (53), shutdowns (57)
+# and PostgREST failing to reach the database. Anything else it reports
+# (constraints, permissions, unknown columns) fails the same way every time.
+TRANSIENT_CLASSES = ("08", "40", "53", "57")
+TRANSIENT_POSTGREST_CODES = ("PGRST000", "PGRST001", "PGRST002", "PGRST003")
+UNIQUE_VIOLATION = "23505"
+
+_clock_lock = threading.Lock()
+_last_timestamp = datetime.fromtimestamp(0, timezone.utc)
+
+def utc_now() -> str:
+    """
+    ISO timestamp that strictly increases within this process. Rows are written
+    in batches, so created_at is stamped here instead of by the database's now(),
+    which would give every row in a batch the same value.
+    """
+    global _last_timestamp
+    with _clock_lock:
+        now = datetime.now(timezone.utc)
+        if now <= _last_timestamp:
+            now = _last_timestamp + timedelta(microseconds=1)
+        _last_timestamp = now
+        return now.isoformat()
+
+def _rejected(error: Exception) -> bool:
+    """True when retrying the write can't help. Connection errors never reach here as APIError."""
+    if not isinstance(error, APIError):
+        return False
+    code = str(error.code or "")
+    if code.isdigit() and len(code) == 3:
+        # A non-JSON response, where the code is the HTTP status
+        return int(code) < 500
+    if code.startswith("PGRST"):
+        return code not in TRANSIENT_POSTGREST_CODES
+    return code[:2] not in TRANSIENT_CLASSES
+
+class WriteBehindQueue:
+    """
+    Buffers inserts for one table and writes them from a background thread as
+    bulk inserts. A single writer drains the queue in FIFO order, so rows for a
+    chat reach the database in the order they were queued. Batches that fail
+    because the database can't be reached stay at the head of the queue and are
+    retried with backoff until they land; only rows the database rejects
+    outright are dropped.
+    """
+
+    def __init__(self, table: str, key: str = "chat_id", flush_interval: float = FLUSH_INTERVAL,
+                 batch_size: int = BATCH_SIZE, max_backlog: int = MAX_BACKLOG,
+                 on_drop: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 client: LazySupabaseClient = supabase):
+        self.table = table
+        self.client = client
+        self.key = key
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_backlog = max_backlog
+        self.on_drop = on_drop
+        self._rows: deque = deque()
+        self._pending: Counter = Counter()
+        # Rows are numbered as they're queued; the queue is FIFO, so every row
+        # numbered up to _finished has been written or dropped
+        self._queued = 0
+        self._finished = 0
+        self._last_queued: Dict[Any, int] = {}
+        self._direct: set = set()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.written = 0
+        self.failed_batches = 0
+        self.dropped = 0
+
+    def enqueue(self, row: Dict[str, Any], timeout: float = 5.0):
+        """
+        Queue a row for insertion, blocking while the backlog is full. If it's
+        still full after `timeout` the row is inserted directly, but only when
+        nothing earlier for its chat is queued; otherwise it has to go in behind
+        those rows, so it's queued past the limit.
+        """
+        key_value = row.get(self.key)
+        with self._cond:
+            self._ensure_started()
+            deadline = time.monotonic() + timeout
+            while len(self._rows) >= self.max_backlog or key_value in self._direct:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and key_value not in self._direct:
+                    break
+                self._cond.wait(max(remaining, 0.05))
+            if len(self._rows) < self.max_backlog or self._pending.get(key_value):
+                self._append(row, key_value)
+                return
+            # Later rows for this chat wait above until the direct insert is done
+            self._direct.add(key_value)
+
+        logger.warning(f"{self.table} write-behind backlog full, inserting synchronously")
+        failed = False
+        try:
+            self.client.table(self.table).insert(row).execute()
+        except Exception as e:
+            if _rejected(e):
+                logger.error(f"Dropping {self.table} row {row.get('id')}: {e}")
+                self.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(row)
+            else:
+                failed = True
+        finally:
+            with self._cond:
+                if failed:
+                    # Still unreachable: keep the row past the limit rather than fail the caller
+                    self._append(row, key_value)
+                self._direct.discard(key_value)
+                self._cond.notify_all()
+
+    def _append(self, row: Dict[str, Any], key_value: Any):
+        self._rows.append(row)
+        self._pending[key_value] += 1
+        self._queued += 1
+        self._last_queued[key_value] = self._queued
+        self._cond.notify_all()
+
+    def pending(self, key_value: Any) -> int:
+        """Number of queued (or in-flight) rows for a chat."""
+        with self._cond:
+            return self._pending.get(key_value, 0)
+
+    def flush(self, timeout: Optional[float] = None, key_value: Any = None) -> bool:
+        """
+        Wait until the rows queued so far (only those for `key_value`, if given)
+        have been written. Rows queued after the call aren't waited for, so this
+        returns under steady traffic too. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            target = self._queued if key_value is None else self._last_queued.get(key_value, 0)
+            self._cond.notify_all()
+            while self._finished < target:
+                if self._thread is None or not self._thread.is_alive():
+                    self._ensure_started()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def start(self):
+        with self._cond:
+            self._ensure_started()
+
+    def stop(self, timeout: float = 10.0):
+        """Flush what's queued and stop the writer thread."""
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+            self._stopping = False
+        if self._rows:
+            logger.error(f"{self.table} write-behind stopped with {len(self._rows)} unwritten rows")
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "backlog": len(self._rows),
+                "written": self.written,
+                "failed_batches": self.failed_batches,
+                "dropped": self.dropped,
+            }
+
+    def _ensure_started(self):
+        # Caller holds self._cond
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.table}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._rows and not self._stopping:
+                    self._cond.wait()
+                if not self._rows:
+                    return
+                if failures:
+                    # The database is unreachable: back off, leaving the rows at the head of the queue
+                    retry_at = time.monotonic() + min(0.25 * 2 ** (failures - 1), 5.0)
+                    while not self._stopping and time.monotonic() < retry_at:
+                        self._cond.wait(retry_at - time.monotonic())
+                    if self._stopping:
+                        return
+                # Give the batch a moment to fill up unless it's already full or we're shutting down
+                elif len(self._rows) < self.batch_size and not self._stopping:
+                    self._cond.wait(self.flush_interval)
+                batch = [self._rows[i] for i in range(min(self.batch_size, len(self._rows)))]
+
+            done, dropped = self._write(batch)
+            failures = 0 if done else failures + 1
+
+            with self._cond:
+                for _ in range(done):
+                    row = self._rows.popleft()
+                    key_value = row.get(self.key)
+                    self._pending[key_value] -= 1
+                    if self._pending[key_value] <= 0:
+                        del self._pending[key_value]
+                        del self._last_queued[key_value]
+                self._finished += done
+                self.written += done - dropped
+                self.dropped += dropped
+                self._cond.notify_all()
+
+    def _write(self, batch) -> Tuple[int, int]:
+        """
+        Insert a batch. Returns how many rows from its head are finished with
+        (written or dropped) and how many of those were dropped.
+        """
+        try:
+            self.client.table(self.table).insert(batch).execute()
+            return len(batch), 0
+        except Exception as e:
+            self.failed_batches += 1
+            logger.error(f"Failed to write {len(batch)} rows to {self.table}: {e}")
+            if not _rejected(e):
+                return 0, 0
+
+        # The database refused something in the batch; go row by row so only the bad rows are dropped
+        dropped = 0
+        for done, row in enumerate(batch):
+            try:
+                self.client.table(self.table).insert(row).execute()
+            except Exception as e:
+                if not _rejected(e):
+                    return done, dropped
+                if getattr(e, "code", None) == UNIQUE_VIOLATION:
+                    # An earlier attempt that looked failed did land
+                    continue
+                dropped += 1
+                logger.error(f"Dropping {self.table} row {row.get('id')}: {e}")
+                if self.on_drop is not None:
+                    self.on_drop(row)
+        return len(batch), dropped
+
+# A dropped message would otherwise stay in the cached history
+message_writer = WriteBehindQueue("messages", on_drop=lambda row: history_cache.invalidate(row["chat_id"]))
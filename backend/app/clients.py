@@ -0,0 +1,76 @@
+from typing import Optional
+from requests.adapters import HTTPAdapter
+
+import time
+import httpx
+import logging
+import requests
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Shared, pooled HTTP clients. Created on first use so importing the app stays cheap,
+# and reused so upstream calls don't pay for a new TCP/TLS handshake every time.
+
+POOL_SIZE = 32
+# Idle keep-alive connections get dropped upstream after a while; don't re-warm more often than this
+WARM_INTERVAL = 20.0
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_async_client: Optional[httpx.AsyncClient] = None
+_warmed_at: dict = {}
+
+def get_http_session() -> requests.Session:
+    """Session used by the (threaded) streaming code for OpenRouter calls."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def get_async_client() -> httpx.AsyncClient:
+    """Client for async endpoints, e.g. validating a user's OpenRouter key."""
+    global _async_client
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                _async_client = httpx.AsyncClient(
+                    timeout=10.0,
+                    limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+                )
+    return _async_client
+
+def claim_warmup(url: str) -> bool:
+    """Reserve the next warm-up of url's host. False if it was warmed in the last WARM_INTERVAL."""
+    now = time.monotonic()
+    with _lock:
+        if now - _warmed_at.get(url, 0.0) < WARM_INTERVAL:
+            return False
+        _warmed_at[url] = now
+        return True
+
+def warm_http_session(url: str):
+    """
+    Open (or refresh) a pooled connection to url's host with a cheap HEAD so the
+    next real request skips the TCP/TLS handshake. Callers throttle with claim_warmup.
+    """
+    try:
+        get_http_session().head(url, timeout=5.0)
+    except Exception as e:
+        logger.warning(f"Failed to warm connection to {url}: {e}")
+
+async def close_http_clients():
+    global _session, _async_client
+    with _lock:
+        session, async_client = _session, _async_client
+        _session, _async_client = None, None
+    if session is not None:
+        session.close()
+    if async_client is not None:
+        await async_client.aclose()
@@ -0,0 +1,15 @@
+from pathlib import Path
+
+import time
+import dotenv
+
+# Taken before the rest of the app is imported so /readyz can report what booting cost
+IMPORT_STARTED = time.perf_counter()
+
+def load_env():
+    """Load backend settings from app/.env, falling back to a .env in the working directory."""
+    app_env = Path(__file__).parent / ".env"
+    dotenv.load_dotenv(app_env if app_env.exists() else dotenv.find_dotenv(usecwd=True))
+
+# Module-level settings elsewhere are read at import, so this has to run first (and only once)
+load_env()
@@ -1,18 +1,35 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Header, WebSocket, WebSocketDisconnect
 from fastapi.requests import Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from postgrest.base_request_builder import APIResponse
-from typing import Optional
-import httpx
+from typing import Optional, List, Dict
+from datetime import date
+from contextlib import asynccontextmanager
 from app import (
     LoginItem, PromptItem, TitleUpdate, SignupItem, ValidateApiKeyRequest, UserResponse, supabase, create_temp_user,
-    get_chat_messages, send_chat_prompt, generate_chat_title,
+    get_chat_messages, send_chat_prompt, send_compare_prompt,
     send_image_prompt, send_pdf_prompt, encryption
 )
+from app.chat.writer import message_writer
+from app.chat.functions import title_chat_later, get_openrouter_key
+from app.chat.history import history_cache
+from app.chat.scheduler import upstream_scheduler
+from app.chat.catalog import model_catalog, ModelRoutingError
+from app.chat.usage import usage_writer, usage_quota, prompt_cache_stats, QuotaExceeded
+from app.chat.idempotency import idempotency_store, IdempotencyConflict, IdempotentRequest, fingerprint
+from app.chat.archive import archiver
+from app.chat.prepare import prepare_chat, take_prepared, warm_upstream, PreparedChat, PREPARE_TTL
+from app.chat.export import export_user_data, gzip_stream, ChatImporter, ChatImportError
+from app.chat.batch import start_batch, get_batch_status, load_batch_request, batch_paths
+from app.models import BatchRequest, ForkItem, PrepareItem
+from app.clients import get_async_client, close_http_clients
+from app.startup import startup_state
 import uuid
-import requests
-import dotenv
+import json
+import zlib
+import asyncio
+import threading
 import os
 import gotrue
 import logging
@@ -20,8 +37,24 @@ import logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 DEBUG = True
-
-app = FastAPI()
+MAX_COMPARE_MODELS = int(os.getenv("MAX_COMPARE_MODELS", "6"))
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "8"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Supabase, the key cipher and HTTP clients are created lazily; warm them up in the background
+    startup_state.start()
+    message_writer.start()
+    usage_writer.start()
+    archiver.start()
+    yield
+    await asyncio.to_thread(archiver.stop)
+    # Don't lose queued messages or usage events when the worker shuts down
+    await asyncio.to_thread(message_writer.stop)
+    await asyncio.to_thread(usage_writer.stop)
+    await close_http_clients()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  
@@ -30,12 +63,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-dotenv.load_dotenv()
-
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
+@app.get("/healthz")
+def get_healthz():
+    """Liveness: the worker is up and serving requests."""
+    return {"status": "ok"}
+
+@app.get("/metrics")
+def get_metrics():
+    """Queue depths, wait times and cache/writer counters for this worker."""
+    return {
+        "upstream_scheduler": upstream_scheduler.stats(),
+        "history_cache":      history_cache.stats(),
+        "message_writer":     message_writer.stats(),
+        "usage_writer":       usage_writer.stats(),
+        "usage_quota":        usage_quota.stats(),
+        "prompt_cache":       prompt_cache_stats.stats(),
+        "idempotency":        idempotency_store.stats(),
+        "archive":            archiver.stats(),
+    }
+
+@app.get("/readyz")
+def get_readyz():
+    """Readiness: every lazily created subsystem has been initialized successfully."""
+    report = startup_state.report()
+    return JSONResponse(report, status_code=200 if startup_state.ready else 503)
+
 @app.post("/signup")
 async def post_signup(item: SignupItem):
     if not item.email or not item.password or not item.openrouter_api_key:
@@ -45,14 +101,13 @@ async def post_signup(item: SignupItem):
         raise HTTPException(status_code=400, detail="Invalid API key format")
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://openrouter.ai/api/v1/models",
-                headers={"Authorization": f"Bearer {item.openrouter_api_key}"},
-                timeout=10.0
-            )
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail="Invalid OpenRouter API key")
+        response = await get_async_client().get(
+            "https://openrouter.ai/api/v1/models",
+            headers={"Authorization": f"Bearer {item.openrouter_api_key}"},
+            timeout=10.0
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail="Invalid OpenRouter API key")
     except Exception as e:
         raise HTTPException(status_code=400, detail="Could not validate API key")
     
@@ -162,14 +217,54 @@ def rename_chat_title(chat_id: str, item: TitleUpdate):
             
     return response.data[0]
 
-def get_user_and_chat(chatId: Optional[str]):
-    """Determine user (or guest) and ensure chatId exists."""
+@app.post("/chats/{chat_id}/fork")
+def fork_chat(chat_id: str, item: ForkItem):
+    """
+    Start a new chat that branches off after one of this chat's messages.
+    Nothing is copied: the new chat records the fork point and its history
+    is read back through it.
+    """
+    user_resp = supabase.auth.get_user()
+    if not user_resp or not user_resp.user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    user = user_resp.user
+
+    chat = supabase.table("chats") \
+        .select("id, title") \
+        .eq("id", chat_id) \
+        .eq("user_id", user.id) \
+        .execute()
+    if not chat.data:
+        raise HTTPException(status_code=404, detail="Chat not found or access denied")
+
+    # The fork point has to be on the branch the user is looking at
+    if item.messageId not in {m.get("id") for m in get_chat_messages(chat_id).data}:
+        raise HTTPException(status_code=404, detail="Message not found in this chat")
+    # forked_from references the row, so it must have been written
+    if message_writer.pending(chat_id):
+        message_writer.flush(timeout=5.0, key_value=chat_id)
+
+    fork_id = str(uuid.uuid4())
+    title = item.title or f'{chat.data[0].get("title") or "New Chat"} (branch)'
+    supabase.table("chats").insert({
+        "id":          fork_id,
+        "user_id":     user.id,
+        "title":       title,
+        "forked_from": item.messageId
+    }).execute()
+    return {"chatId": fork_id, "title": title, "forkedFrom": item.messageId}
+
+def current_user():
+    """The signed-in user, or a new guest."""
     user_resp = supabase.auth.get_user()
     if not user_resp:
         logger.info("Guest Mode active")
-        user = create_temp_user().user
-    else:
-        user = user_resp.user
+        return create_temp_user().user
+    return user_resp.user
+
+def get_user_and_chat(chatId: Optional[str], user=None):
+    """Determine user (or guest) and ensure chatId exists."""
+    user = user or current_user()
 
     chat_exists = False
     if chatId:
@@ -189,16 +284,42 @@ def get_user_and_chat(chatId: Optional[str]):
 
     return user, chatId
 
+def claim_idempotency_key(scope: str, key: Optional[str], request_fingerprint: str, user_id: str):
+    """Returns (entry, duplicate). entry is None when the client didn't send an Idempotency-Key."""
+    if not key:
+        return None, False
+    try:
+        entry, created = idempotency_store.begin(scope, user_id, key, request_fingerprint)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return entry, not created
+
+def replay_idempotent(entry: IdempotentRequest):
+    """Answer a duplicate request from the original one: same stream, or the same error."""
+    if not entry.wait_started():
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still being processed")
+    if entry.outcome is not None:
+        if isinstance(entry.outcome, Exception):
+            raise entry.outcome
+        return entry.outcome
+    return StreamingResponse(
+        entry.follow(),
+        media_type=entry.media_type,
+        headers={**entry.headers, "Idempotent-Replayed": "true"}
+    )
+
+def stream_response(stream, headers: dict, entry: Optional[IdempotentRequest] = None):
+    if entry is not None:
+        stream = entry.stream(stream, headers, "text/event-stream")
+    return StreamingResponse(stream, media_type="text/event-stream", headers=headers)
+
 # Send chat info
 @app.get("/models")
 def get_models():
-    headers = {
-        "Authorization": f'Bearer {os.getenv("OPEN_ROUTER_KEY")}',  # Changed to use OPEN_ROUTER_KEY
-        "Content-Type": "application/json"
-    }
-    r = requests.get("https://openrouter.ai/api/v1/models", headers=headers)
-    if r.status_code >= 200 and r.status_code <= 299:
-        return r.json()  
+    # Served from the cached catalogue that also drives model routing
+    models = model_catalog.raw()
+    if models is not None:
+        return models
     else:
         return {"error": "Failed to retrieve models"}
 
@@ -222,62 +343,135 @@ def get_chats():
         print("No user logged in")
         return {"error": "No user logged in"}
 
+def open_chat(item: PromptItem, user, models: List[str], owner_only: bool = False,
+              prepared: Optional[PreparedChat] = None, on_title=None):
+    """
+    Find or create the prompt's chat and load its history. New chats are titled
+    in the background (see title_chat_later). Returns (messages, chat_exists).
+    Shared by /chat and /ws. A prepared chat from /chat/prepare skips the
+    lookups it already did.
+    """
+    # Check if chat exists. If not, create it.
+    chat_exists = bool(prepared and prepared.chat_exists)
+    if item.chatId and not chat_exists:
+        # More efficient query to check for existence
+        res = supabase.table("chats").select("id, user_id", count='exact').eq("id", item.chatId).execute()
+        if res.count > 0:
+            chat_exists = True
+            if owner_only and res.data[0].get("user_id") != user.id:
+                raise HTTPException(status_code=403, detail="Access denied")
+
+    if not chat_exists:
+        # If no chatId provided by client, generate one.
+        if not item.chatId:
+            item.chatId = str(uuid.uuid4())
+        
+        # Create the chat record.
+        supabase.table("chats").insert({
+            "id": item.chatId, 
+            "user_id": user.id, 
+            "title": "New Chat"
+        }).execute()
+        
+        # Title it off the request path; the first turn shouldn't wait behind background work
+        title_chat_later(item.chatId, item.prompt, user.id, on_title)
+
+    # Load messages for context and add the prompt to the db
+    print(f"ChatID: {item.chatId}")
+    messages = (prepared and prepared.history()) or get_chat_messages(item.chatId)
+    messages.data.sort(key=lambda m: m.get("created_at"))
+
+    # Make sure the whole conversation still fits the model's context window
+    prompt_chars = len(item.prompt) + sum(len(m.get("content") or "") for m in messages.data)
+    for model in models:
+        model_catalog.route(model, prompt_chars=prompt_chars)
+
+    return messages, chat_exists
+
+@app.post("/chat/prepare")
+def post_chat_prepare(item: PrepareItem):
+    """
+    Called while the user is typing. Warms the upstream connections and resolves
+    the key and history the next /chat would need; pass the returned token as
+    that request's prepareToken.
+    """
+    user_resp = supabase.auth.get_user()
+    if not user_resp:
+        # Signing a guest in here would swap the server's session on every keystroke; /chat does it once
+        warm_upstream()
+        return {"token": None, "expiresIn": 0}
+    user = user_resp.user
+
+    try:
+        token = prepare_chat(user, item.chatId, item.model)
+    except Exception as e:
+        # Preparing is only an optimisation; /chat will do the work itself
+        logger.error(f"Could not prepare chat {item.chatId}: {e}")
+        return {"token": None, "expiresIn": 0}
+    return {"token": token, "expiresIn": PREPARE_TTL}
+
 @app.post("/chat")
-def chat(item: PromptItem):
+def chat(item: PromptItem, idempotency_key: Optional[str] = Header(None)):
+    # A /chat/prepare token already resolved the user, their key and the history
+    prepared = take_prepared(item.prepareToken, item.chatId)
     try:
         # Get the current user to assign the chat to them.
-        user = supabase.auth.get_user()
-        if not user:
-            logger.info("Guest Mode active")
-            user = create_temp_user().user
-        else: 
-            user = user.user
+        user = prepared.user if prepared else current_user()
+    except Exception as e:
+        logger.error(f"Error in /chat endpoint for chat {item.chatId}: {e}", exc_info=True)
+        return {"error": str(e)}
 
-        # Check if chat exists. If not, create it.
-        chat_exists = False
-        if item.chatId:
-            # More efficient query to check for existence
-            res = supabase.table("chats").select("id", count='exact').eq("id", item.chatId).execute()
-            if res.count > 0:
-                chat_exists = True
+    # A retried request attaches to (or replays) the first one instead of generating again
+    entry, duplicate = claim_idempotency_key("chat", idempotency_key, fingerprint(item.model_dump_json()), user.id)
+    if duplicate:
+        return replay_idempotent(entry)
 
-        generated_title = None
+    try:
+        response = run_chat(item, user, prepared, entry)
+    except HTTPException as e:
+        if entry is not None:
+            idempotency_store.abandon(entry, e)
+        raise
+    if entry is not None and not isinstance(response, StreamingResponse):
+        idempotency_store.abandon(entry, response)
+    return response
+
+def run_chat(item: PromptItem, user, prepared: Optional[PreparedChat] = None,
+             entry: Optional[IdempotentRequest] = None):
+    try:
+        # Reject models that don't exist before doing any work for them
+        compare_models = list(dict.fromkeys(item.models or []))
+        if len(compare_models) > MAX_COMPARE_MODELS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_COMPARE_MODELS} models can be compared at once")
+        if len(compare_models) == 1:
+            # A single model isn't a comparison; it's the model this turn uses
+            item.model = compare_models[0]
+            compare_models = []
+        for model in compare_models or [item.model]:
+            model_catalog.route(model)
+
+        # Only the shared key has a quota; it's checked against the in-memory counter, not a query per turn
+        openrouter_key = prepared.openrouter_key if prepared else get_openrouter_key(user)
+        usage_quota.check(user.id, openrouter_key)
+
+        messages, chat_exists = open_chat(item, user, compare_models or [item.model], prepared=prepared)
+
+        # Add headers for new chats; the title follows on /chat/{id}/title
+        headers = {}
         if not chat_exists:
-            # If no chatId provided by client, generate one.
-            if not item.chatId:
-                item.chatId = str(uuid.uuid4())
-            
-            # Create the chat record.
-            supabase.table("chats").insert({
-                "id": item.chatId, 
-                "user_id": user.id, 
-                "title": "New Chat"
-            }).execute()
-            
-            # Generate a title for the new chat.
-            try:
-                generated_title = generate_chat_title(item.prompt)
-                supabase.table("chats").update({"title": generated_title}).eq("id", item.chatId).execute()
-            except Exception as title_e:
-                # Log the error but don't fail the whole request.
-                logger.error(f"Could not generate chat title for chat {item.chatId}: {title_e}")
-                generated_title = "New Chat"
-
-        # Load messages for context and add the prompt to the db
-        print(f"ChatID: {item.chatId}")
-        messages = get_chat_messages(item.chatId)
-        messages.data.sort(key=lambda m: m.get("created_at"))
+            headers["X-Chat-Id"] = item.chatId
 
         # Create the streaming response with headers
-        response = StreamingResponse(send_chat_prompt(item, user, messages), media_type="text/event-stream")
-        
-        # Add headers for new chats
-        if not chat_exists:
-            response.headers["X-Chat-Id"] = item.chatId
-            if generated_title:
-                response.headers["X-Chat-Title"] = generated_title
-        
-        return response
+        if compare_models:
+            return stream_response(send_compare_prompt(item, user, messages, compare_models, openrouter_key), headers, entry)
+        else:
+            return stream_response(send_chat_prompt(item, user, messages, openrouter_key=openrouter_key), headers, entry)
+    except ModelRoutingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except QuotaExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in /chat endpoint for chat {item.chatId}: {e}", exc_info=True)
         return {"error": str(e)}
@@ -287,24 +481,49 @@ async def chat_upload_image(
     model:     str                = Form(...),
     chatId:    Optional[str]      = Form(None),
     prompt:    str                = Form(""),
-    file:      UploadFile         = File(...)
+    file:      UploadFile         = File(...),
+    idempotency_key: Optional[str] = Header(None)
 ):
-    # 1) Lookup or create user + chat
-    user, chatId = get_user_and_chat(chatId)
+    # 0) Make sure some model can actually look at an image
+    try:
+        model_catalog.route(model, {"image"})
+    except ModelRoutingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # 2) Read file bytes once
+    # 1) Read file bytes once
     file_bytes    = await file.read()
     content_type  = file.content_type
 
-    # 3) Build PromptItem
+    # 2) A retried upload from the same user attaches to (or replays) the first one
+    scope = "chat/upload/image"
+    user = current_user()
+    entry, duplicate = claim_idempotency_key(
+        scope, idempotency_key, fingerprint(model, chatId, prompt, file.filename, file_bytes), user.id
+    )
+    if duplicate:
+        return await asyncio.to_thread(replay_idempotent, entry)
+
+    # 3) Lookup or create the chat
+    try:
+        user, chatId = get_user_and_chat(chatId, user)
+        openrouter_key = get_openrouter_key(user)
+        usage_quota.check(user.id, openrouter_key)
+    except QuotaExceeded as e:
+        error = HTTPException(status_code=429, detail=str(e))
+        if entry is not None:
+            idempotency_store.abandon(entry, error)
+        raise error
+    except Exception as e:
+        if entry is not None:
+            idempotency_store.abandon(entry, HTTPException(status_code=500, detail=str(e)))
+        raise
+
+    # 4) Build PromptItem
     item = PromptItem(model=model, chatId=chatId, prompt=prompt)
 
-    # 4) Stream via the image helper
+    # 5) Stream via the image helper
     try:
-        return StreamingResponse(
-            send_image_prompt(item, file_bytes, content_type),
-            media_type="text/event-stream"
-        )
+        return stream_response(send_image_prompt(item, user, file_bytes, content_type, openrouter_key), {}, entry)
     except Exception as e:
         logger.error("Error in /chat/upload/image:", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -315,28 +534,319 @@ async def chat_upload_pdf(
     model:     str                = Form(...),
     chatId:    Optional[str]      = Form(None),
     prompt:    str                = Form(""),
-    file:      UploadFile         = File(...)
+    file:      UploadFile         = File(...),
+    idempotency_key: Optional[str] = Header(None)
 ):
-    # 1) Lookup or create user + chat
-    user, chatId = get_user_and_chat(chatId)
-
-    # 2) Read file bytes once
+    # 0) PDFs go to a file-capable model when there is one (otherwise the text fallback handles them)
+    if model_catalog.capable({"file"}):
+        try:
+            model_catalog.route(model, {"file"})
+        except ModelRoutingError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # 1) Read file bytes once
     file_bytes    = await file.read()
     content_type  = file.content_type
 
-    # 3) Build PromptItem
+    # 2) A retried upload from the same user attaches to (or replays) the first one
+    scope = "chat/upload/pdf"
+    user = current_user()
+    entry, duplicate = claim_idempotency_key(
+        scope, idempotency_key, fingerprint(model, chatId, prompt, file.filename, file_bytes), user.id
+    )
+    if duplicate:
+        return await asyncio.to_thread(replay_idempotent, entry)
+
+    # 3) Lookup or create the chat
+    try:
+        user, chatId = get_user_and_chat(chatId, user)
+        openrouter_key = get_openrouter_key(user)
+        usage_quota.check(user.id, openrouter_key)
+    except QuotaExceeded as e:
+        error = HTTPException(status_code=429, detail=str(e))
+        if entry is not None:
+            idempotency_store.abandon(entry, error)
+        raise error
+    except Exception as e:
+        if entry is not None:
+            idempotency_store.abandon(entry, HTTPException(status_code=500, detail=str(e)))
+        raise
+
+    # 4) Build PromptItem
     item = PromptItem(model=model, chatId=chatId, prompt=prompt)
 
-    # 4) Stream via the PDF helper
+    # 5) Stream via the PDF helper
     try:
-        return StreamingResponse(
-            send_pdf_prompt(item, file_bytes, content_type),
-            media_type="text/event-stream"
+        return stream_response(
+            send_pdf_prompt(item, user, file_bytes, content_type, file.filename or "document.pdf", openrouter_key), {}, entry
         )
     except Exception as e:
         logger.error("Error in /chat/upload/pdf:", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+def authenticate_websocket(websocket: WebSocket):
+    """The user for a socket's access token, from ?token= (browsers can't set headers) or a Bearer header."""
+    token = websocket.query_params.get("token")
+    auth_header = websocket.headers.get("Authorization")
+    if not token and auth_header and auth_header.startswith("Bearer "):
+        token = auth_header.split(" ")[1]
+    if not token:
+        return None
+    try:
+        user = supabase.auth.get_user(token)
+        return user.user if user else None
+    except Exception:
+        return None
+
+def run_socket_prompt(item: PromptItem, user, request_id: str, cancelled: threading.Event, send, finished):
+    """Run one /ws prompt through the /chat pipeline, sending tagged events until it ends or is cancelled."""
+    tag = {"requestId": request_id, "chatId": item.chatId}
+    try:
+        model_catalog.route(item.model)
+        openrouter_key = get_openrouter_key(user)
+        usage_quota.check(user.id, openrouter_key)
+        messages, chat_exists = open_chat(
+            item, user, [item.model], owner_only=True,
+            on_title=lambda title: send({"type": "title", **tag, "chatId": item.chatId, "title": title})
+        )
+        tag["chatId"] = item.chatId
+        send({"type": "start", **tag, "new": not chat_exists})
+        if cancelled.is_set():
+            send({"type": "cancelled", **tag})
+            return
+
+        reply = send_chat_prompt(item, user, messages, openrouter_key=openrouter_key)
+        try:
+            for content in reply:
+                if cancelled.is_set():
+                    send({"type": "cancelled", **tag})
+                    return
+                send({"type": "token", **tag, "content": content})
+        finally:
+            # Closing the generator also closes the upstream connection
+            reply.close()
+        send({"type": "done", **tag})
+    except (ModelRoutingError, QuotaExceeded) as e:
+        send({"type": "error", **tag, "error": str(e)})
+    except HTTPException as e:
+        send({"type": "error", **tag, "error": e.detail})
+    except Exception as e:
+        logger.error(f"Error in /ws prompt {request_id} for chat {item.chatId}: {e}", exc_info=True)
+        send({"type": "error", **tag, "error": str(e)})
+    finally:
+        finished(request_id)
+
+@app.websocket("/ws")
+async def chat_socket(websocket: WebSocket):
+    """
+    One authenticated connection for any number of concurrent generations.
+    Client messages:
+      {"type": "prompt", "requestId", "chatId", "model", "prompt", "webSearchEnabled"}
+      {"type": "cancel", "requestId"}
+    Server messages are tagged with requestId and chatId:
+      start, token, done, cancelled, error, and title once a new chat has one
+    """
+    user = await asyncio.to_thread(authenticate_websocket, websocket)
+    if user is None:
+        await websocket.close(code=1008, reason="Unauthorized")
+        return
+    await websocket.accept()
+
+    loop = asyncio.get_running_loop()
+    outbox: asyncio.Queue = asyncio.Queue()
+    inflight: Dict[str, threading.Event] = {}
+
+    def send(message: dict):
+        # Called from worker threads; one sender task owns the socket
+        loop.call_soon_threadsafe(outbox.put_nowait, message)
+
+    def finished(request_id: str):
+        loop.call_soon_threadsafe(inflight.pop, request_id, None)
+
+    async def sender():
+        while True:
+            message = await outbox.get()
+            await websocket.send_json(message)
+
+    sender_task = asyncio.create_task(sender())
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                request_id = str(message.get("requestId") or "")
+            except (json.JSONDecodeError, AttributeError):
+                send({"type": "error", "requestId": None, "error": "Messages must be JSON objects"})
+                continue
+            if not request_id:
+                send({"type": "error", "requestId": None, "error": "requestId is required"})
+                continue
+
+            if message.get("type") == "cancel":
+                cancelled = inflight.get(request_id)
+                if cancelled is not None:
+                    cancelled.set()
+                continue
+            if message.get("type") != "prompt":
+                send({"type": "error", "requestId": request_id, "error": f"Unknown message type: {message.get('type')}"})
+                continue
+
+            if request_id in inflight:
+                send({"type": "error", "requestId": request_id, "error": "requestId is already in use"})
+                continue
+            if len(inflight) >= WS_MAX_INFLIGHT:
+                send({"type": "error", "requestId": request_id, "error": f"At most {WS_MAX_INFLIGHT} generations per connection"})
+                continue
+            try:
+                item = PromptItem(
+                    chatId=message.get("chatId") or "",
+                    model=message.get("model"),
+                    prompt=message.get("prompt"),
+                    webSearchEnabled=message.get("webSearchEnabled", False)
+                )
+            except ValueError as e:
+                send({"type": "error", "requestId": request_id, "error": str(e)})
+                continue
+
+            inflight[request_id] = threading.Event()
+            threading.Thread(
+                target=run_socket_prompt,
+                args=(item, user, request_id, inflight[request_id], send, finished),
+                name=f"ws-{request_id[:8]}",
+                daemon=True
+            ).start()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Stop generating for a client that's gone
+        for cancelled in inflight.values():
+            cancelled.set()
+        sender_task.cancel()
+
+def get_owned_batch(batch_id: str, user):
+    """Load a stored batch request, checking it exists and belongs to the user."""
+    try:
+        stored = load_batch_request(batch_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid batch id")
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    owner_id, request = stored
+    if owner_id != user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return request
+
+@app.post("/batch")
+def post_batch(item: BatchRequest):
+    """Run every prompt against every model in the background. Poll /batch/{batchId} for progress."""
+    if not item.prompts or not item.models:
+        raise HTTPException(status_code=400, detail="At least one prompt and one model are required")
+    # Unknown models would otherwise fail once per prompt, each after an upstream call
+    try:
+        for model in dict.fromkeys(item.models):
+            model_catalog.route(model)
+    except ModelRoutingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    user_resp = supabase.auth.get_user()
+    if not user_resp:
+        logger.info("Guest Mode active")
+        user = create_temp_user().user
+    else:
+        user = user_resp.user
+
+    return start_batch(item, user).status()
+
+@app.post("/batch/{batch_id}/resume")
+def resume_batch(batch_id: str):
+    """Re-run the items of a batch that haven't succeeded yet."""
+    user_resp = supabase.auth.get_user()
+    if not user_resp or not user_resp.user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    request = get_owned_batch(batch_id, user_resp.user)
+    return start_batch(request, user_resp.user, str(uuid.UUID(batch_id))).status()
+
+@app.get("/batch/{batch_id}")
+def get_batch(batch_id: str):
+    user_resp = supabase.auth.get_user()
+    if not user_resp or not user_resp.user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    get_owned_batch(batch_id, user_resp.user)
+    return get_batch_status(str(uuid.UUID(batch_id)))
+
+@app.get("/batch/{batch_id}/results")
+def get_batch_results(batch_id: str):
+    """The batch's JSONL artifact: one line per finished item with output, latency and token usage."""
+    user_resp = supabase.auth.get_user()
+    if not user_resp or not user_resp.user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    get_owned_batch(batch_id, user_resp.user)
+    _, results_path = batch_paths(batch_id)
+    if not results_path.exists():
+        raise HTTPException(status_code=404, detail="No results yet")
+    return FileResponse(results_path, media_type="application/x-ndjson")
+
+@app.get("/export")
+def get_export(gzip: bool = False):
+    """Every chat and message of the user as NDJSON (optionally gzipped), streamed page by page."""
+    user_resp = supabase.auth.get_user()
+    if not user_resp or not user_resp.user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    stream = export_user_data(user_resp.user.id)
+    filename = f"q2-chat-export-{date.today().isoformat()}.ndjson"
+    media_type = "application/x-ndjson"
+    if gzip:
+        stream = gzip_stream(stream)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        stream,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.post("/import")
+async def post_import(request: Request):
+    """
+    Load an /export file, sent as the request body (NDJSON, gzipped or not).
+    The body is decompressed and parsed as it arrives and written in batches,
+    so only one batch is ever held in memory.
+    """
+    user_resp = await asyncio.to_thread(supabase.auth.get_user)
+    if not user_resp or not user_resp.user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    importer = ChatImporter(user_resp.user.id)
+
+    def feed(lines):
+        for line in lines:
+            importer.feed_line(line)
+
+    decompressor = None
+    pending = b""
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if decompressor is None:
+                gzipped = chunk.startswith(b"\x1f\x8b") or request.headers.get("Content-Encoding") == "gzip"
+                decompressor = zlib.decompressobj(31) if gzipped else False
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            # Inserting a batch blocks, so parse and write off the event loop
+            await asyncio.to_thread(feed, lines)
+        if decompressor:
+            pending += decompressor.flush()
+        await asyncio.to_thread(feed, pending.split(b"\n"))
+        return await asyncio.to_thread(importer.finish)
+    except zlib.error as e:
+        raise HTTPException(status_code=400, detail={"error": f"Invalid gzip data: {e}", **importer.summary()})
+    except ChatImportError as e:
+        # Batches already written stay; ids are stable, so re-sending the file skips them
+        raise HTTPException(status_code=400, detail={"error": str(e), **importer.summary()})
+
 @app.get("/chat/{chat_id}/title")
 def get_chat_title(chat_id: str):
     # Query Supabase for just the title field
@@ -433,14 +943,13 @@ async def update_api_key(api_key_request: ValidateApiKeyRequest, request: Reques
         raise HTTPException(status_code=400, detail="Invalid API key format")
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://openrouter.ai/api/v1/models",
-                headers={"Authorization": f"Bearer {api_key_request.api_key}"},
-                timeout=10.0
-            )
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail="Invalid OpenRouter API key")
+        response = await get_async_client().get(
+            "https://openrouter.ai/api/v1/models",
+            headers={"Authorization": f"Bearer {api_key_request.api_key}"},
+            timeout=10.0
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail="Invalid OpenRouter API key")
     except Exception:
         raise HTTPException(status_code=400, detail="Could not validate API key")
     
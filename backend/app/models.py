@@ -13,6 +13,14 @@ class PromptItem(BaseModel):
     model: str
     prompt: str
     webSearchEnabled: Optional[bool] = False
+    models: Optional[List[str]] = None  # compare mode: stream every model's reply at once
+    prepareToken: Optional[str] = None  # from /chat/prepare: reuse the key and history it resolved
+
+class BatchRequest(BaseModel):
+    prompts: List[str]
+    models: List[str]
+    concurrency: int = 4
+    webSearchEnabled: Optional[bool] = False
 
 class UpdateTitleItem(BaseModel):
     title: str
@@ -58,6 +66,14 @@ class ChatResponse(BaseModel):
 class TitleUpdate(BaseModel):
     title: str
     
+class PrepareItem(BaseModel):
+    chatId: Optional[str] = None  # None while typing the first message of a new chat
+    model: Optional[str] = None
+
+class ForkItem(BaseModel):
+    messageId: str  # the new branch continues after this message
+    title: Optional[str] = None
+
 class SignupItem(BaseModel):
     email: str
     password: str
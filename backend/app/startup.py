@@ -0,0 +1,60 @@
+from typing import Dict, Any
+
+from app.config import IMPORT_STARTED
+from app.auth.supabase_client import supabase
+from app.auth.encryption import encryption
+from app.clients import get_http_session, get_async_client
+from app.chat.catalog import model_catalog
+
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Subsystems that are created lazily, in the order the worker warms them up after boot
+SUBSYSTEMS = {
+    "supabase":   supabase.get,
+    "encryption": lambda: encryption.cipher,
+    "http":       lambda: (get_http_session(), get_async_client()),
+    # Never fails (a missing catalogue just disables routing checks) but saves the first /chat a fetch
+    "models":     model_catalog.raw,
+}
+
+class StartupState:
+    """Tracks the background warm-up so /readyz can tell when the worker is ready for traffic."""
+
+    def __init__(self):
+        self.import_seconds = None
+        self.checks: Dict[str, Dict[str, Any]] = {}
+        self.finished = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.finished.is_set() and all(check["ok"] for check in self.checks.values())
+
+    def initialize(self):
+        for name, init in SUBSYSTEMS.items():
+            started = time.perf_counter()
+            try:
+                init()
+                self.checks[name] = {"ok": True, "seconds": round(time.perf_counter() - started, 3)}
+            except Exception as e:
+                logger.error(f"Failed to initialize {name}: {e}")
+                self.checks[name] = {"ok": False, "error": str(e)}
+        self.finished.set()
+
+    def start(self):
+        """Record how long importing took and warm everything up without blocking startup."""
+        self.import_seconds = round(time.perf_counter() - IMPORT_STARTED, 3)
+        logger.info(f"App imported in {self.import_seconds}s")
+        threading.Thread(target=self.initialize, name="startup-warmup", daemon=True).start()
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "status":         "ready" if self.ready else "starting" if not self.finished.is_set() else "unavailable",
+            "import_seconds": self.import_seconds,
+            "checks":         self.checks,
+        }
+
+startup_state = StartupState()
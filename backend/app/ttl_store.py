@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Optional, Any, Callable, Hashable, Tuple
+
+import time
+import threading
+
+class TTLStore:
+    """
+    Thread-safe key/value store whose entries expire after `ttl` seconds.
+    Holds at most `max_entries`, dropping the oldest entries first.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (value, created). The factory only runs if there's no live entry for the key."""
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                return value, False
+            value = factory()
+            self._set(key, value, None)
+            return value, True
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._get(key)
+            self._entries.pop(key, None)
+            return value
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._purge()
+            return len(self._entries)
+
+    def _get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+
+    def _set(self, key: Hashable, value: Any, ttl: Optional[float]):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+        self._purge()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _purge(self):
+        # Entries are in insertion order and share a ttl, so expired ones are at the front
+        now = time.monotonic()
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
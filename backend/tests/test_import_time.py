@@ -0,0 +1,56 @@
+"""
+Importing the app has to stay cheap: workers are restarted and scaled often,
+and everything slow (the Supabase client, the PBKDF2 key derivation, HTTP
+clients) is created lazily after boot. Run with `python -m pytest tests` from
+backend/.
+"""
+from pathlib import Path
+
+import os
+import sys
+import json
+import subprocess
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Generous enough for a cold CI container; a regression to eager init costs far more
+IMPORT_BUDGET_SECONDS = float(os.getenv("IMPORT_BUDGET_SECONDS", "2.0"))
+
+PROBE = """
+import sys, time, json
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+from app.auth.supabase_client import supabase
+from app.auth.encryption import encryption
+print(json.dumps({
+    "seconds":              elapsed,
+    "supabase_imported":    "supabase" in sys.modules,
+    "supabase_initialized": supabase.initialized,
+    "cipher_initialized":   encryption.initialized,
+}))
+"""
+
+def import_app() -> dict:
+    # A fresh interpreter, so nothing imported by the test runner is already cached
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        timeout=60,
+        env={**os.environ, "ENCRYPTION_KEY": os.getenv("ENCRYPTION_KEY", "import-time-test")},
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_import_within_budget():
+    report = import_app()
+    assert report["seconds"] < IMPORT_BUDGET_SECONDS, \
+        f"import app took {report['seconds']:.2f}s (budget {IMPORT_BUDGET_SECONDS}s)"
+
+def test_import_does_not_initialize_clients():
+    report = import_app()
+    assert not report["supabase_imported"], "the supabase SDK was imported at import time"
+    assert not report["supabase_initialized"], "the Supabase client was created at import time"
+    assert not report["cipher_initialized"], "the PBKDF2 key cipher was derived at import time"
@@ -0,0 +1,7 @@
+-- ====================================================================
+-- Index: messages (chat_id, created_at)
+-- Purpose: Keep per-chat history loads and the "latest message" probe
+--          used to revalidate the backend's history cache cheap.
+-- ====================================================================
+create index if not exists messages_chat_id_created_at_idx
+    on public.messages (chat_id, created_at desc);
@@ -0,0 +1,49 @@
+-- ====================================================================
+-- Table: usage_events
+-- Purpose: One row per upstream completion with its token counts, so
+--          spend (especially on the shared server key) can be seen and
+--          capped per user. Written in batches by the backend.
+-- ====================================================================
+create table if not exists usage_events (
+    id uuid primary key default gen_random_uuid(), -- unique event ID
+    user_id uuid not null references users(id) on delete cascade, -- who made the request
+    chat_id uuid references chats(id) on delete set null, -- chat it belonged to (null for titles)
+    model text not null, -- model the request was sent to
+    prompt_tokens integer not null default 0,
+    completion_tokens integer not null default 0,
+    cached_tokens integer not null default 0, -- prompt tokens served from the provider's cache
+    cost numeric, -- provider-reported cost in USD, when available
+    estimated boolean not null default false, -- counts estimated locally (no usage chunk)
+    shared_key boolean not null default false, -- billed to the shared server key
+    created_at timestamp with time zone default now()
+);
+
+create index if not exists usage_events_user_id_created_at_idx
+    on public.usage_events (user_id, created_at);
+
+-- ====================================================================
+-- View: usage_daily
+-- Purpose: Per-user, per-day rollup used to seed the backend's quota
+--          counters and for reporting.
+-- ====================================================================
+create or replace view usage_daily
+with (security_invoker = true) as
+select
+    user_id,
+    (created_at at time zone 'utc')::date as day,
+    count(*) as requests,
+    sum(prompt_tokens) as prompt_tokens,
+    sum(completion_tokens) as completion_tokens,
+    sum(cached_tokens) as cached_tokens,
+    sum(prompt_tokens + completion_tokens) filter (where shared_key) as shared_tokens,
+    sum(cost) as cost
+from public.usage_events
+group by user_id, (created_at at time zone 'utc')::date;
+
+alter table public.usage_events enable row level security;
+
+create policy "select_own_usage" on public.usage_events
+    for select using ( auth.uid() = user_id );
+
+create policy "insert_own_usage" on public.usage_events
+    for insert with check ( auth.uid() = user_id );
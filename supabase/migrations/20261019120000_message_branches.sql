@@ -0,0 +1,60 @@
+-- ====================================================================
+-- Columns: messages.parent_id, chats.forked_from
+-- Purpose: Turn a chat's messages into a tree so a conversation can be
+--          branched from any message without copying rows. A chat's
+--          history is the path from its newest message back to the root;
+--          a fork starts at the message it was forked from.
+-- ====================================================================
+alter table public.messages
+    add column if not exists parent_id uuid references public.messages(id) on delete set null; -- previous message on the branch
+
+alter table public.chats
+    add column if not exists forked_from uuid references public.messages(id) on delete set null; -- fork point, for branched chats
+
+-- Existing chats are linear: each message's parent is the one before it
+with ordered as (
+    select id, lag(id) over (partition by chat_id order by created_at, id) as parent_id
+    from public.messages
+)
+update public.messages m
+set parent_id = ordered.parent_id
+from ordered
+where m.id = ordered.id
+  and m.parent_id is null
+  and ordered.parent_id is not null;
+
+-- Walking up a branch is a primary key lookup per step; this index serves
+-- the other direction (a message's branches) and parent deletes.
+create index if not exists messages_parent_id_idx
+    on public.messages (parent_id);
+
+-- ====================================================================
+-- Function: chat_history(chat_id)
+-- Purpose: The messages on a chat's current branch, oldest first, in one
+--          recursive query. The head is the chat's newest message (found
+--          with messages_chat_id_created_at_idx) or its fork point.
+-- ====================================================================
+create or replace function public.chat_history(p_chat_id uuid)
+returns setof public.messages
+language sql stable
+as $$
+    with recursive head as (
+        select coalesce(
+            (select id from public.messages where chat_id = p_chat_id order by created_at desc limit 1),
+            (select forked_from from public.chats where id = p_chat_id)
+        ) as id
+    ),
+    branch as (
+        select m.id, m.parent_id, 0 as depth
+        from public.messages m
+        join head on m.id = head.id
+        union all
+        select m.id, m.parent_id, branch.depth + 1
+        from public.messages m
+        join branch on m.id = branch.parent_id
+    )
+    select m.*
+    from branch
+    join public.messages m on m.id = branch.id
+    order by branch.depth desc;
+$$;
@@ -0,0 +1,58 @@
+-- ====================================================================
+-- Indexes for /export
+-- Purpose: Keyset iteration over a user's chats (by id) and over the
+--          messages of those chats (by created_at, id), so each page is
+--          an index range scan no matter how deep into the export it is.
+-- ====================================================================
+create index if not exists chats_user_id_id_idx
+    on public.chats (user_id, id);
+
+create index if not exists messages_created_at_id_idx
+    on public.messages (created_at, id);
+
+-- ====================================================================
+-- Function: import_chat_batch(user_id, chats, messages, forks)
+-- Purpose: Insert one batch of an /import. A function call runs in a
+--          single transaction, so a batch is written completely or not
+--          at all. Rows that already exist are skipped, which makes
+--          re-sending a partly imported file safe. Fork points are linked
+--          once the messages they point to exist.
+-- ====================================================================
+create or replace function public.import_chat_batch(
+    p_user_id uuid,
+    p_chats jsonb,
+    p_messages jsonb,
+    p_forks jsonb default '[]'::jsonb
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    chat_count integer;
+    message_count integer;
+begin
+    insert into public.chats (id, user_id, title, created_at)
+    select c.id, p_user_id, c.title, coalesce(c.created_at, now())
+    from jsonb_populate_recordset(null::public.chats, p_chats) c
+    on conflict (id) do nothing;
+    get diagnostics chat_count = row_count;
+
+    -- Messages can only land in the importing user's chats
+    insert into public.messages
+    select m.*
+    from jsonb_populate_recordset(null::public.messages, p_messages) m
+    where m.chat_id in (select id from public.chats where user_id = p_user_id)
+    on conflict (id) do nothing;
+    get diagnostics message_count = row_count;
+
+    update public.chats c
+    set forked_from = f.forked_from
+    from jsonb_to_recordset(p_forks) as f(chat_id uuid, forked_from uuid)
+    where c.id = f.chat_id
+      and c.user_id = p_user_id
+      and c.forked_from is null
+      and exists (select 1 from public.messages m where m.id = f.forked_from);
+
+    return jsonb_build_object('chats', chat_count, 'messages', message_count);
+end;
+$$;
@@ -0,0 +1,134 @@
+-- ====================================================================
+-- Columns: chats.archived_at, archive_path, archived_messages,
+--          archived_bytes
+-- Purpose: A chat with no activity for a while has its messages moved
+--          to a zstd-compressed JSON blob in the chat-archives bucket.
+--          The chats row stays behind as a stub pointing at the blob
+--          until the chat is opened again.
+-- ====================================================================
+alter table public.chats
+    add column if not exists archived_at timestamp with time zone, -- when the messages were moved out
+    add column if not exists archive_path text, -- object path in the chat-archives bucket
+    add column if not exists archived_messages integer, -- rows removed from messages
+    add column if not exists archived_bytes bigint; -- approximate size of those rows
+
+insert into storage.buckets (id, name, public)
+values ('chat-archives', 'chat-archives', false)
+on conflict (id) do nothing;
+
+-- ====================================================================
+-- Function: archivable_chats(cutoff, limit)
+-- Purpose: Hot chats whose newest message is older than the cutoff.
+--          Chats that take part in a branch are skipped, since other
+--          chats' histories run through (or out of) their rows.
+-- ====================================================================
+create or replace function public.archivable_chats(p_cutoff timestamp with time zone, p_limit integer)
+returns table (id uuid, user_id uuid)
+language sql stable
+as $$
+    select c.id, c.user_id
+    from public.chats c
+    where c.archived_at is null
+      and c.forked_from is null
+      and (select max(m.created_at) from public.messages m where m.chat_id = c.id) < p_cutoff
+      and not exists (
+          select 1
+          from public.chats f
+          join public.messages fm on fm.id = f.forked_from
+          where fm.chat_id = c.id
+      )
+      and not exists (
+          select 1
+          from public.messages child
+          join public.messages parent on parent.id = child.parent_id
+          where parent.chat_id = c.id and child.chat_id <> c.id
+      )
+    order by c.created_at
+    limit p_limit;
+$$;
+
+-- ====================================================================
+-- Function: archive_chat(chat_id, path, messages, bytes, last_created_at)
+-- Purpose: Delete a chat's messages once their blob is stored, and mark
+--          the chat archived. Does nothing (returns false) if anything
+--          was written to the chat after the blob was built.
+-- ====================================================================
+create or replace function public.archive_chat(
+    p_chat_id uuid,
+    p_path text,
+    p_messages integer,
+    p_bytes bigint,
+    p_last_created_at timestamp with time zone
+)
+returns boolean
+language plpgsql
+as $$
+begin
+    perform 1 from public.chats where id = p_chat_id and archived_at is null for update;
+    if not found then
+        return false;
+    end if;
+
+    if (select count(*) from public.messages where chat_id = p_chat_id) <> p_messages
+       or (select max(created_at) from public.messages where chat_id = p_chat_id) is distinct from p_last_created_at then
+        return false;
+    end if;
+
+    delete from public.messages where chat_id = p_chat_id;
+    update public.chats
+    set archived_at = now(),
+        archive_path = p_path,
+        archived_messages = p_messages,
+        archived_bytes = p_bytes
+    where id = p_chat_id;
+    return true;
+end;
+$$;
+
+-- ====================================================================
+-- Function: restore_chat(chat_id, messages)
+-- Purpose: Put an archived chat's messages back and clear the stub, in
+--          one transaction. Safe to call twice: the second call finds the
+--          chat no longer archived and returns 0.
+-- ====================================================================
+create or replace function public.restore_chat(p_chat_id uuid, p_messages jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    restored integer;
+begin
+    perform 1 from public.chats where id = p_chat_id and archived_at is not null for update;
+    if not found then
+        return 0;
+    end if;
+
+    insert into public.messages
+    select m.*
+    from jsonb_populate_recordset(null::public.messages, p_messages) m
+    where m.chat_id = p_chat_id
+    on conflict (id) do nothing;
+    get diagnostics restored = row_count;
+
+    update public.chats
+    set archived_at = null,
+        archive_path = null,
+        archived_messages = null,
+        archived_bytes = null
+    where id = p_chat_id;
+    return restored;
+end;
+$$;
+
+-- ====================================================================
+-- View: chat_archive_stats
+-- Purpose: How much has been moved out of the hot messages table.
+-- ====================================================================
+create or replace view chat_archive_stats
+with (security_invoker = true) as
+select
+    count(*) as archived_chats,
+    coalesce(sum(archived_messages), 0) as archived_messages,
+    coalesce(sum(archived_bytes), 0) as archived_bytes
+from public.chats
+where archived_at is not null;
@@ -0,0 +1,46 @@
+-- ====================================================================
+-- Table: job_leases
+-- Purpose: Which backend worker runs a periodic job. Every worker runs
+--          the job's loop, but a pass only does work in the worker that
+--          holds the lease. The holder renews it each pass; if it stops,
+--          the lease expires and another worker takes over.
+-- ====================================================================
+create table if not exists public.job_leases (
+    name text primary key, -- the job, e.g. chat-archiver
+    holder text not null, -- worker id (host:pid:nonce)
+    expires_at timestamp with time zone not null
+);
+
+-- No policies: only the service role reaches it
+alter table public.job_leases enable row level security;
+
+-- ====================================================================
+-- Function: claim_job_lease(name, holder, seconds)
+-- Purpose: Take or renew a job lease. Returns true if the caller holds
+--          it for the next `seconds`, null if another worker does.
+-- ====================================================================
+create or replace function public.claim_job_lease(p_name text, p_holder text, p_seconds integer)
+returns boolean
+language sql
+as $$
+    insert into public.job_leases as l (name, holder, expires_at)
+    values (p_name, p_holder, now() + make_interval(secs => p_seconds))
+    on conflict (name) do update
+        set holder = excluded.holder,
+            expires_at = excluded.expires_at
+        where l.expires_at < now() or l.holder = excluded.holder
+    returning true;
+$$;
+
+-- ====================================================================
+-- The archive job runs on the service-role client. Its functions work
+-- across users' chats, so clients can't call them directly.
+-- ====================================================================
+revoke execute on function public.archivable_chats(timestamp with time zone, integer) from public, anon, authenticated;
+revoke execute on function public.archive_chat(uuid, text, integer, bigint, timestamp with time zone) from public, anon, authenticated;
+revoke execute on function public.restore_chat(uuid, jsonb) from public, anon, authenticated;
+revoke execute on function public.claim_job_lease(text, text, integer) from public, anon, authenticated;
+grant execute on function public.archivable_chats(timestamp with time zone, integer) to service_role;
+grant execute on function public.archive_chat(uuid, text, integer, bigint, timestamp with time zone) to service_role;
+grant execute on function public.restore_chat(uuid, jsonb) to service_role;
+grant execute on function public.claim_job_lease(text, text, integer) to service_role;
@@ -0,0 +1,97 @@
+-- ====================================================================
+-- usage_events is written in batches by the backend on the service-role
+-- client, and guests (anonymous sign-ins) only exist in auth.users, so
+-- point user_id there like chats.user_id and drop the per-user insert
+-- policy.
+-- ====================================================================
+alter table public.usage_events
+    drop constraint if exists usage_events_user_id_fkey,
+    add constraint usage_events_user_id_fkey
+        foreign key (user_id)
+        references auth.users(id)
+        on delete cascade;
+
+drop policy if exists "insert_own_usage" on public.usage_events;
+
+-- ====================================================================
+-- Table: usage_daily
+-- Purpose: Per-user, per-day totals used to seed and re-sync the
+--          backend's quota counters and for reporting. Replaces the
+--          view of the same name, which re-aggregated usage_events on
+--          every read. Kept up to date by the trigger below.
+-- ====================================================================
+drop view if exists public.usage_daily;
+
+create table if not exists public.usage_daily (
+    user_id uuid not null references auth.users(id) on delete cascade,
+    day date not null, -- UTC day
+    requests integer not null default 0,
+    prompt_tokens bigint not null default 0,
+    completion_tokens bigint not null default 0,
+    cached_tokens bigint not null default 0,
+    shared_tokens bigint not null default 0, -- prompt + completion tokens on the shared key
+    cost numeric not null default 0,
+    primary key (user_id, day)
+);
+
+insert into public.usage_daily (user_id, day, requests, prompt_tokens, completion_tokens, cached_tokens, shared_tokens, cost)
+select
+    user_id,
+    (created_at at time zone 'utc')::date,
+    count(*),
+    sum(prompt_tokens),
+    sum(completion_tokens),
+    sum(cached_tokens),
+    coalesce(sum(prompt_tokens + completion_tokens) filter (where shared_key), 0),
+    coalesce(sum(cost), 0)
+from public.usage_events
+group by user_id, (created_at at time zone 'utc')::date
+on conflict (user_id, day) do nothing;
+
+alter table public.usage_daily enable row level security;
+
+create policy "select_own_usage_daily" on public.usage_daily
+    for select using ( auth.uid() = user_id );
+
+-- ====================================================================
+-- Function: roll_up_usage_events()
+-- Purpose: Add each inserted batch of usage_events to usage_daily, one
+--          upsert per user and day. Runs in the insert's transaction,
+--          so a batch that fails (or is retried) is never counted twice.
+-- ====================================================================
+create or replace function public.roll_up_usage_events()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    insert into public.usage_daily as d (user_id, day, requests, prompt_tokens, completion_tokens, cached_tokens, shared_tokens, cost)
+    select
+        user_id,
+        (created_at at time zone 'utc')::date,
+        count(*),
+        sum(prompt_tokens),
+        sum(completion_tokens),
+        sum(cached_tokens),
+        coalesce(sum(prompt_tokens + completion_tokens) filter (where shared_key), 0),
+        coalesce(sum(cost), 0)
+    from new_events
+    group by user_id, (created_at at time zone 'utc')::date
+    on conflict (user_id, day) do update
+        set requests = d.requests + excluded.requests,
+            prompt_tokens = d.prompt_tokens + excluded.prompt_tokens,
+            completion_tokens = d.completion_tokens + excluded.completion_tokens,
+            cached_tokens = d.cached_tokens + excluded.cached_tokens,
+            shared_tokens = d.shared_tokens + excluded.shared_tokens,
+            cost = d.cost + excluded.cost;
+    return null;
+end;
+$$;
+
+drop trigger if exists usage_events_roll_up on public.usage_events;
+create trigger usage_events_roll_up
+    after insert on public.usage_events
+    referencing new table as new_events
+    for each statement
+    execute function public.roll_up_usage_events();
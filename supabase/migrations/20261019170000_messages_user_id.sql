@@ -0,0 +1,48 @@
+-- ====================================================================
+-- Column: messages.user_id
+-- Purpose: The owner of the message's chat, copied onto the message so
+--          /export can page through one user's messages by
+--          (user_id, created_at, id) instead of walking the global
+--          (created_at, id) index and filtering by chat owner. Kept in
+--          step with chats.user_id by the trigger below; deletes still
+--          cascade through chats.
+-- ====================================================================
+alter table public.messages
+    add column if not exists user_id uuid;
+
+update public.messages m
+set user_id = c.user_id
+from public.chats c
+where c.id = m.chat_id
+  and m.user_id is distinct from c.user_id;
+
+-- ====================================================================
+-- Function: set_message_user_id()
+-- Purpose: Stamp every inserted message (live writes, imports, archive
+--          restores) with its chat's owner. Any value sent by the
+--          caller is overwritten, so a message can't be filed under
+--          another user.
+-- ====================================================================
+create or replace function public.set_message_user_id()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    new.user_id := (select user_id from public.chats where id = new.chat_id);
+    return new;
+end;
+$$;
+
+drop trigger if exists messages_set_user_id on public.messages;
+create trigger messages_set_user_id
+    before insert or update of chat_id, user_id on public.messages
+    for each row
+    execute function public.set_message_user_id();
+
+create index if not exists messages_user_id_created_at_id_idx
+    on public.messages (user_id, created_at, id);
+
+-- Only /export used it
+drop index if exists public.messages_created_at_id_idx;